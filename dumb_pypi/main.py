@@ -12,28 +12,48 @@ from __future__ import annotations
 import argparse
 import collections
 import contextlib
-import inspect
+import functools
+import hashlib
+import heapq
+import io
 import itertools
 import json
 import math
+import operator
 import os.path
+import pickle
 import re
 import sys
-import tempfile
+import time
 from datetime import datetime
 from typing import Any
+from typing import Callable
+from typing import Dict
 from typing import Generator
 from typing import IO
+from typing import Iterable
 from typing import Iterator
+from typing import List
 from typing import NamedTuple
+from typing import Optional
 from typing import Sequence
+from typing import Tuple
+from typing import TYPE_CHECKING
 
-import jinja2
-import packaging.utils
+import packaging
 import packaging.version
 
+# These are only needed for some builds (or not at all when nothing changed),
+# so they're imported where they're used to keep startup fast.
+if TYPE_CHECKING:
+    import concurrent.futures
+    import tarfile
+
+    import jinja2
+
 CHANGELOG_ENTRIES_PER_PAGE = 5000
 DIGIT_RE = re.compile('([0-9]+)', re.ASCII)
+NORMALIZE_RE = re.compile('[-_.]+')
 # Copied from distlib/wheel.py
 WHEEL_FILENAME_RE = re.compile(r'''
 (?P<nm>[^-]+)
@@ -46,6 +66,13 @@ WHEEL_FILENAME_RE = re.compile(r'''
 ''', re.IGNORECASE | re.VERBOSE)
 
 
+def _canonicalize_name(name: str) -> str:
+    # The same as packaging.utils.canonicalize_name (PEP 503), which isn't
+    # used because importing packaging.utils also imports packaging.tags,
+    # which is slow.
+    return NORMALIZE_RE.sub('-', name).lower()
+
+
 def remove_extension(name: str) -> str:
     if name.endswith(('gz', 'bz2')):
         name, _ = name.rsplit('.', 1)
@@ -108,6 +135,7 @@ class Package(NamedTuple):
     requires_python: str | None
     upload_timestamp: int | None
     uploaded_by: str | None
+    metadata_hash: str | None
 
     def __lt__(self, other: tuple[Any, ...]) -> bool:
         assert isinstance(other, Package), type(other)
@@ -175,11 +203,33 @@ class Package(NamedTuple):
             ret['digests'] = {algo: h}
         return ret
 
+    def simple_json_info(self, base_url: str) -> dict[str, Any]:
+        """A file entry for the PEP 691 JSON simple API."""
+        ret: dict[str, Any] = {
+            'filename': self.filename,
+            'url': self.url(base_url, include_hash=False),
+            'hashes': {},
+        }
+        if self.hash is not None:
+            algo, h = self.hash.split('=')
+            ret['hashes'][algo] = h
+        if self.requires_python is not None:
+            ret['requires-python'] = self.requires_python
+        if self.metadata_hash is not None:
+            # PEP 714, and the older name from PEP 691
+            algo, h = self.metadata_hash.split('=')
+            ret['core-metadata'] = ret['dist-info-metadata'] = {algo: h}
+        if self.upload_timestamp is not None:
+            # PEP 700
+            dt = datetime.utcfromtimestamp(self.upload_timestamp)
+            ret['upload-time'] = dt.strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+        return ret
+
     def input_json(self) -> dict[str, Any]:
         """A dict suitable for json lines."""
         return {
             k: getattr(self, k)
-            for k in inspect.getfullargspec(self.create).kwonlyargs
+            for k in _input_keys()
             if getattr(self, k) is not None
         }
 
@@ -193,32 +243,390 @@ class Package(NamedTuple):
             requires_python: str | None = None,
             upload_timestamp: int | None = None,
             uploaded_by: str | None = None,
+            metadata_hash: str | None = None,
     ) -> Package:
-        if not re.match(r'[a-zA-Z0-9_\-\.\+]+$', filename) or '..' in filename:
-            raise ValueError(f'Unsafe package name: {filename}')
-
-        name, version = guess_name_version_from_filename(filename)
+        name, version, parsed_version = _parse_filename(filename)
         return cls(
             filename=filename,
-            name=packaging.utils.canonicalize_name(name),
+            name=name,
             version=version,
-            parsed_version=packaging.version.parse(version or '0'),
+            parsed_version=parsed_version,
             hash=hash,
-            requires_dist=tuple(requires_dist) if requires_dist is not None else None,
-            requires_python=requires_python,
+            requires_dist=_intern_requires_dist(requires_dist),
+            requires_python=_intern(requires_python),
             upload_timestamp=upload_timestamp,
-            uploaded_by=uploaded_by,
+            uploaded_by=_intern(uploaded_by),
+            metadata_hash=metadata_hash,
         )
 
 
+@functools.lru_cache(maxsize=None)
+def _input_keys() -> tuple[str, ...]:
+    """The keys of the JSON package list, i.e. the arguments of Package.create."""
+    import inspect
+    return tuple(inspect.getfullargspec(Package.create).kwonlyargs)
+
+
+# Big registries have millions of files but far fewer distinct names,
+# versions, uploaders and requirements, so those are interned to share a single
+# copy between all of the files which have them.
+_interned_requires_dist: dict[tuple[str, ...], tuple[str, ...]] = {}
+
+
+def _intern(s: str | None) -> str | None:
+    return sys.intern(s) if s is not None else None
+
+
+def _intern_requires_dist(requires_dist: Sequence[str] | None) -> tuple[str, ...] | None:
+    if requires_dist is None:
+        return None
+    requires_dist = tuple(requires_dist)
+    try:
+        return _interned_requires_dist[requires_dist]
+    except KeyError:
+        interned = tuple(sys.intern(requirement) for requirement in requires_dist)
+        return _interned_requires_dist.setdefault(interned, interned)
+
+
+# Parsing filenames is one of the more expensive parts of reading a package
+# list, and the same filenames show up over and over (in both the current and
+# previous package lists, and across runs), so the results are memoized here.
+# Parsed versions are shared between all files with the same version string.
+# With --cache-dir, the memo is also persisted between runs.
+_parsed_filenames: dict[str, tuple[str, str | None, packaging.version.Version]] = {}
+_parsed_versions: dict[str, packaging.version.Version] = {}
+
+
+def _parse_filename(filename: str) -> tuple[str, str | None, packaging.version.Version]:
+    """Return the canonical name, version, and parsed version for a filename."""
+    try:
+        return _parsed_filenames[filename]
+    except KeyError:
+        pass
+
+    if not re.match(r'[a-zA-Z0-9_\-\.\+]+$', filename) or '..' in filename:
+        raise ValueError(f'Unsafe package name: {filename}')
+
+    name, version = guess_name_version_from_filename(filename)
+    version_str = version or '0'
+    parsed_version = _parsed_versions.get(version_str)
+    if parsed_version is None:
+        parsed_version = _parsed_versions[version_str] = packaging.version.parse(version_str)
+    parsed = _parsed_filenames[filename] = (
+        sys.intern(_canonicalize_name(name)),
+        _intern(version),
+        parsed_version,
+    )
+    return parsed
+
+
+# Bump this if the format of the parse cache (or the parsing itself) changes.
+PARSE_CACHE_VERSION = 1
+PARSE_CACHE_FILENAME = 'parse-cache.pickle'
+
+
+def _parse_cache_header() -> tuple[int, str]:
+    # Parsed versions are pickled, so the cache is only valid for the same
+    # version of packaging.
+    return (PARSE_CACHE_VERSION, packaging.__version__)
+
+
+def _load_parse_cache(cache_dir: str) -> None:
+    try:
+        with open(os.path.join(cache_dir, PARSE_CACHE_FILENAME), 'rb') as f:
+            if pickle.load(f) != _parse_cache_header():
+                return
+            entries = pickle.load(f)
+    except FileNotFoundError:
+        return
+    except Exception as ex:
+        print(f'Ignoring unreadable parse cache: {ex!r}', file=sys.stderr)
+        return
+    for filename, (name, version, parsed_version) in entries.items():
+        _remember_parsed_filename(filename, name, version, parsed_version)
+
+
+def _remember_parsed_filename(
+        filename: str,
+        name: str,
+        version: str | None,
+        parsed_version: packaging.version.Version,
+) -> None:
+    """Seed the parse memo with an already parsed (e.g. unpickled) filename."""
+    parsed_version = _parsed_versions.setdefault(version or '0', parsed_version)
+    _parsed_filenames.setdefault(filename, (sys.intern(name), _intern(version), parsed_version))
+
+
+def _save_parse_cache(cache_dir: str, filenames: set[str]) -> None:
+    """Save the parse cache, keeping only the given filenames.
+
+    Dropping the filenames which no longer appear in the package lists keeps
+    the cache the same size as the registry.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    entries = {
+        filename: parsed
+        for filename, parsed in _parsed_filenames.items()
+        if filename in filenames
+    }
+    with atomic_write(os.path.join(cache_dir, PARSE_CACHE_FILENAME), 'wb') as f:
+        pickle.dump(_parse_cache_header(), f, protocol=pickle.HIGHEST_PROTOCOL)
+        pickle.dump(entries, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+# Bump this if the format of the snapshot changes in a way that isn't caught
+# by the header (which includes the fields of Package).
+SNAPSHOT_VERSION = 1
+SNAPSHOT_FILENAME = 'packages.snapshot'
+
+
+def _snapshot_header() -> tuple[int, str, tuple[str, ...]]:
+    return (SNAPSHOT_VERSION, packaging.__version__, Package._fields)
+
+
+def _write_snapshot(sorted_packages: dict[str, list[Package]], writer: _Writer) -> None:
+    with writer.open(SNAPSHOT_FILENAME, 'wb') as f:
+        pickle.dump(_snapshot_header(), f, protocol=pickle.HIGHEST_PROTOCOL)
+        pickle.dump(sorted_packages, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def read_snapshot(path: str) -> dict[str, list[Package]] | None:
+    """Read the sorted packages from a snapshot written by build_repo.
+
+    Returns None if the snapshot is missing or was written by an incompatible
+    version of dumb-pypi (in which case a full rebuild is needed).
+    """
+    try:
+        with open(path, 'rb') as f:
+            header = pickle.load(f)
+            if header != _snapshot_header():
+                print(f'Ignoring snapshot from another version of dumb-pypi: {path}', file=sys.stderr)
+                return None
+            sorted_packages: dict[str, list[Package]] = pickle.load(f)
+    except FileNotFoundError:
+        print(f'Snapshot not found, doing a full rebuild: {path}', file=sys.stderr)
+        return None
+    except Exception as ex:
+        print(f'Ignoring unreadable snapshot: {ex!r}', file=sys.stderr)
+        return None
+
+    # The current package list mostly contains the same filenames, so let it
+    # reuse the parsed names and versions.
+    for files in sorted_packages.values():
+        for package in files:
+            _remember_parsed_filename(package.filename, package.name, package.version, package.parsed_version)
+    return sorted_packages
+
+
+def _gzip_compress(data: bytes, *, level: int) -> bytes:
+    import gzip
+    buf = io.BytesIO()
+    # A fixed mtime keeps the output repeatable.
+    with gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=level, mtime=0) as f:
+        f.write(data)
+    return buf.getvalue()
+
+
+# Bump this if the format of the metadata cache changes.
+METADATA_CACHE_VERSION = 1
+METADATA_CACHE_FILENAME = 'metadata-cache.pickle'
+METADATA_FILENAME_RE = re.compile(r'[^/]+\.dist-info/METADATA')
+
+
+class _WheelMetadata(NamedTuple):
+    """What's taken from the METADATA of a wheel, for a given wheel file."""
+    size: int
+    mtime_ns: int
+    metadata_hash: str
+    requires_dist: tuple[str, ...]
+    requires_python: str | None
+
+
+def _read_wheel_metadata(path: str) -> bytes:
+    """Read the METADATA file out of a wheel.
+
+    Only the zip's central directory and the METADATA member are read, not
+    the rest of the wheel.
+    """
+    import zipfile
+    with zipfile.ZipFile(path) as zf:
+        names = [name for name in zf.namelist() if METADATA_FILENAME_RE.fullmatch(name)]
+        if len(names) != 1:
+            raise ValueError(f'expected one .dist-info/METADATA file, found {len(names)}')
+        return zf.read(names[0])
+
+
+def _wheel_metadata(
+        packages_dir: str,
+        cache: dict[str, _WheelMetadata],
+        package: Package,
+) -> _WheelMetadata | None:
+    """Get the metadata of a wheel in packages_dir, and write its PEP 658
+    <wheel>.metadata file next to it.
+
+    Returns None if the wheel isn't in packages_dir or can't be read.
+    """
+    path = os.path.join(packages_dir, package.filename)
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    metadata_path = path + '.metadata'
+    cached = cache.get(package.filename)
+    if (
+            cached is not None and
+            (cached.size, cached.mtime_ns) == (st.st_size, st.st_mtime_ns) and
+            os.path.exists(metadata_path)
+    ):
+        return cached
+
+    import email.parser
+    import zipfile
+    try:
+        metadata = _read_wheel_metadata(path)
+    except (OSError, ValueError, zipfile.BadZipFile) as ex:
+        print(f'Unable to read metadata from {package.filename}: {ex}', file=sys.stderr)
+        return None
+
+    try:
+        with open(metadata_path, 'rb') as f:
+            unchanged = f.read() == metadata
+    except FileNotFoundError:
+        unchanged = False
+    if not unchanged:
+        with atomic_write(metadata_path, 'wb') as f:
+            f.write(metadata)
+
+    headers = email.parser.HeaderParser().parsestr(metadata.decode('utf-8', 'replace'))
+    return _WheelMetadata(
+        size=st.st_size,
+        mtime_ns=st.st_mtime_ns,
+        metadata_hash=f'sha256={hashlib.sha256(metadata).hexdigest()}',
+        requires_dist=tuple(headers.get_all('Requires-Dist') or ()),
+        requires_python=headers.get('Requires-Python'),
+    )
+
+
+def _load_metadata_cache(cache_dir: str) -> dict[str, _WheelMetadata]:
+    try:
+        with open(os.path.join(cache_dir, METADATA_CACHE_FILENAME), 'rb') as f:
+            if pickle.load(f) != METADATA_CACHE_VERSION:
+                return {}
+            return {filename: _WheelMetadata(*entry) for filename, entry in pickle.load(f).items()}
+    except FileNotFoundError:
+        return {}
+    except Exception as ex:
+        print(f'Ignoring unreadable metadata cache: {ex!r}', file=sys.stderr)
+        return {}
+
+
+def _save_metadata_cache(cache_dir: str, cache: dict[str, _WheelMetadata]) -> None:
+    os.makedirs(cache_dir, exist_ok=True)
+    with atomic_write(os.path.join(cache_dir, METADATA_CACHE_FILENAME), 'wb') as f:
+        pickle.dump(METADATA_CACHE_VERSION, f, protocol=pickle.HIGHEST_PROTOCOL)
+        # Plain tuples, so that the cache doesn't depend on the name of the
+        # class.
+        entries = {filename: tuple(entry) for filename, entry in cache.items()}
+        pickle.dump(entries, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def _with_wheel_metadata(package: Package, metadata: _WheelMetadata) -> Package:
+    return package._replace(
+        metadata_hash=metadata.metadata_hash,
+        requires_dist=(
+            package.requires_dist
+            if package.requires_dist is not None
+            else _intern_requires_dist(metadata.requires_dist)
+        ),
+        requires_python=(
+            package.requires_python
+            if package.requires_python is not None
+            else _intern(metadata.requires_python)
+        ),
+    )
+
+
+def add_wheel_metadata(
+        packages: dict[str, set[Package]],
+        packages_dir: str,
+        *,
+        cache_dir: str | None = None,
+        jobs: int = 1,
+        known: dict[str, _WheelMetadata] | None = None,
+) -> None:
+    """Fill in the metadata of the wheels in packages which are available in
+    packages_dir, and write their PEP 658 metadata files.
+
+    This sets metadata_hash, as well as requires_dist and requires_python
+    unless they were already given in the package list. With cache_dir, the
+    metadata is cached by the size and mtime of each wheel.
+
+    known holds the metadata of the wheels already handled by this process,
+    which isn't looked at again; it's updated to the wheels in packages (so
+    --watch only handles the wheels that are new in each package list).
+    """
+    if known is None:
+        known = {}
+    wheels = [
+        package
+        for files in packages.values()
+        for package in files
+        if package.filename.endswith('.whl')
+    ]
+    new_wheels = [package for package in wheels if package.filename not in known]
+    results: dict[str, _WheelMetadata | None] = dict(known)
+    if new_wheels:
+        import concurrent.futures
+        cache = _load_metadata_cache(cache_dir) if cache_dir else {}
+        # Reading the wheels is mostly I/O and decompression, both of which
+        # release the GIL, so threads are enough.
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+            new_results = executor.map(functools.partial(_wheel_metadata, packages_dir, cache), new_wheels)
+            for package, metadata in zip(new_wheels, new_results):
+                results[package.filename] = metadata
+
+    new_cache = {}
+    for package in wheels:
+        metadata = results[package.filename]
+        if metadata is None:
+            continue
+        new_cache[package.filename] = metadata
+        files = packages[package.name]
+        files.remove(package)
+        files.add(_with_wheel_metadata(package, metadata))
+    if cache_dir and new_wheels:
+        _save_metadata_cache(cache_dir, new_cache)
+    known.clear()
+    known.update(new_cache)
+
+
+def add_known_wheel_metadata(
+        packages: dict[str, set[Package]],
+        known: dict[str, _WheelMetadata],
+) -> None:
+    """Fill in the metadata of the wheels in packages which are in known
+    (from add_wheel_metadata), without looking at any wheels.
+
+    This is for the previous package list, so that its wheels compare equal
+    to the same wheels in the current one.
+    """
+    for files in packages.values():
+        for package in tuple(files):
+            metadata = known.get(package.filename)
+            if metadata is not None:
+                files.remove(package)
+                files.add(_with_wheel_metadata(package, metadata))
+
+
 @contextlib.contextmanager
-def atomic_write(path: str) -> Generator[IO[str], None, None]:
+def atomic_write(path: str, mode: str = 'w') -> Generator[IO[Any], None, None]:
+    import tempfile
     tmp = tempfile.mktemp(
         prefix='.' + os.path.basename(path),
         dir=os.path.dirname(path),
     )
     try:
-        with open(tmp, 'w') as f:
+        with open(tmp, mode) as f:
             yield f
     except BaseException:
         os.remove(tmp)
@@ -231,6 +639,13 @@ def _format_datetime(dt: datetime) -> str:
     return dt.strftime('%Y-%m-%d %H:%M:%S')
 
 
+# The JSON simple API (PEP 691). PEP 700's upload-time and versions keys are
+# included, but API version 1.1 also requires the size of every file, which
+# dumb-pypi never sees, so this only claims 1.0 (clients ignore extra keys).
+SIMPLE_JSON_META = {'api-version': '1.0'}
+SIMPLE_JSON_CONTENT_TYPE = 'application/vnd.pypi.simple.v1+json'
+
+
 IMPORTANT_METADATA_FOR_INFO = frozenset((
     'name',
     'version',
@@ -239,6 +654,20 @@ IMPORTANT_METADATA_FOR_INFO = frozenset((
 ))
 
 
+def _info_file(sorted_files: list[Package]) -> Package:
+    # Find a file from the latest release to use for "info". We don't want to
+    # mix-and-match the metadata across releases since tools like Poetry rely
+    # on this, but we do want to pick the file in the release with the most
+    # populated metadata.
+    latest_version = sorted_files[-1].version
+    if latest_version is None:
+        return sorted_files[-1]
+    return max(
+        (file_ for file_ in sorted_files if file_.version == latest_version),
+        key=lambda f: sum(bool(getattr(f, v)) for v in IMPORTANT_METADATA_FOR_INFO),
+    )
+
+
 def _package_json(sorted_files: list[Package], base_url: str) -> dict[str, Any]:
     # https://warehouse.pypa.io/api-reference/json.html
     # note: the full api contains much more, we only output the info we have
@@ -247,16 +676,7 @@ def _package_json(sorted_files: list[Package], base_url: str) -> dict[str, Any]:
         if file.version is not None:
             by_version[file.version].append(file)
 
-    # Find a file from the latest release to use for "info". We don't want to
-    # mix-and-match the metadata across releases since tools like Poetry rely
-    # on this, but we do want to pick the file in the release with the most
-    # populated metadata.
-    latest_file = sorted_files[-1]
-    if sorted_files[-1].version is not None:
-        latest_file = max(
-            by_version[sorted_files[-1].version],
-            key=lambda f: sum(bool(getattr(f, v)) for v in IMPORTANT_METADATA_FOR_INFO),
-        )
+    latest_file = _info_file(sorted_files)
 
     return {
         'info': {
@@ -278,6 +698,46 @@ def _package_json(sorted_files: list[Package], base_url: str) -> dict[str, Any]:
     }
 
 
+# Most requirements are shared by many files, so each distinct string is only
+# parsed once.
+@functools.lru_cache(maxsize=None)
+def _requirement_name(requirement: str) -> str | None:
+    """The canonical name of the project a requirement is on, if it's valid."""
+    import packaging.requirements
+    try:
+        return _canonicalize_name(packaging.requirements.Requirement(requirement).name)
+    except packaging.requirements.InvalidRequirement:
+        return None
+
+
+def _dependency_names(sorted_files: list[Package]) -> set[str]:
+    """The canonical names of the projects in a package's "info" requires_dist."""
+    return {
+        name
+        for name in map(_requirement_name, _info_file(sorted_files).requires_dist or ())
+        if name is not None
+    }
+
+
+def _reverse_dependencies(sorted_packages: dict[str, list[Package]]) -> dict[str, list[dict[str, Any]]]:
+    """Find the dependents of each project, by canonical name.
+
+    Like pypi/{package}/json, this goes by the requires_dist of the latest
+    release of each package.
+    """
+    dependents: dict[str, list[dict[str, Any]]] = collections.defaultdict(list)
+    for package_name, sorted_files in sorted_packages.items():
+        info_file = _info_file(sorted_files)
+        requirements: dict[str, list[str]] = collections.defaultdict(list)
+        for requirement in info_file.requires_dist or ():
+            name = _requirement_name(requirement)
+            if name is not None:
+                requirements[name].append(requirement)
+        for name, requires in requirements.items():
+            dependents[name].append({'name': package_name, 'version': info_file.version, 'requires': requires})
+    return dependents
+
+
 class Settings(NamedTuple):
     output_dir: str
     packages_url: str
@@ -286,133 +746,1172 @@ class Settings(NamedTuple):
     logo_width: int
     generate_timestamp: bool
     disable_per_release_json: bool
+    jobs: int = 1
+    skip_unchanged: bool = False
+    digest_file: str | None = None
+    cache_dir: str | None = None
+    gzip_level: int | None = None
+    brotli_quality: int | None = None
+    simple_json: bool = False
+    output_tar: str | None = None
+    output_tar_compression: str | None = None
+    output_s3: str | None = None
+    s3_endpoint_url: str | None = None
+    s3_max_connections: int = 16
+    manifest: str | None = None
+    manifest_format: str = 'jsonl'
+    reverse_dependencies: bool = False
+    bulk_json: bool = False
+
+
+# What a writer in a worker process sends back to the parent; see
+# _Writer.result() and _Writer.merge().
+_WriterResult = Tuple[
+    int,
+    int,
+    int,
+    Dict[str, Optional[str]],
+    List[Tuple[str, str, Optional[str]]],
+    List[Tuple[str, Optional[bytes]]],
+]
+
+
+class _Writer:
+    """Writes build outputs, given as '/'-separated paths relative to the
+    output directory.
+
+    With `skip_unchanged`, each output is first rendered into memory and its
+    SHA-256 digest is compared against the stored digest for that path (when
+    a digest file is used) or against the file already on disk. Identical
+    outputs are left untouched so their mtimes don't change.
+
+    With `gzip_level` and/or `brotli_quality`, each text output that gets
+    written is also written precompressed next to it (as <name>.gz and
+    <name>.br), for webservers which can serve those directly.
+    """
+
+    # Whether outputs can be written straight to files as they're rendered,
+    # rather than rendering them into memory first.
+    streams_to_files = True
+
+    def __init__(
+            self,
+            output_dir: str,
+            *,
+            skip_unchanged: bool = False,
+            digests: dict[str, str] | None = None,
+            gzip_level: int | None = None,
+            brotli_quality: int | None = None,
+            record_changes: bool = False,
+    ) -> None:
+        self.output_dir = output_dir
+        self.skip_unchanged = skip_unchanged
+        self.digests = digests
+        self.compressors: list[tuple[str, Callable[[bytes], bytes]]] = []
+        if gzip_level is not None:
+            self.compressors.append(('.gz', functools.partial(_gzip_compress, level=gzip_level)))
+        if brotli_quality is not None:
+            import brotli
+            self.compressors.append(('.br', functools.partial(brotli.compress, quality=brotli_quality)))
+        self.written = 0
+        self.skipped = 0
+        self.bytes_written = 0
+        # Digests set (or removed, as None) since this writer was created, so
+        # that worker processes can send them back to the parent.
+        self.changed_digests: dict[str, str | None] = {}
+        # The (name, action, SHA-256) of each file created, modified or
+        # deleted, for --manifest.
+        self.changes: list[tuple[str, str, str | None]] | None = [] if record_changes else None
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.output_dir, *name.split('/'))
+
+    def _exists(self, name: str) -> bool:
+        return os.path.exists(self._path(name))
+
+    def _read(self, name: str) -> bytes | None:
+        try:
+            with open(self._path(name), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def _write(self, name: str, data: bytes) -> None:
+        path = self._path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with atomic_write(path, 'wb') as f:
+            f.write(data)
+
+    def _delete(self, name: str) -> None:
+        """Delete a file, along with any directories left empty."""
+        path = self._path(name)
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(path)
+        directory = os.path.dirname(path)
+        while os.path.abspath(directory) != os.path.abspath(self.output_dir):
+            try:
+                os.rmdir(directory)
+            except OSError:
+                break
+            directory = os.path.dirname(directory)
+
+    def _existing_digest(self, name: str) -> str | None:
+        if self.digests is not None and name in self.digests and self._exists(name):
+            return self.digests[name]
+        data = self._read(name)
+        return hashlib.sha256(data).hexdigest() if data is not None else None
+
+    def _set_digest(self, name: str, digest: str | None) -> None:
+        if self.digests is not None:
+            if digest is None:
+                self.digests.pop(name, None)
+            else:
+                self.digests[name] = digest
+            self.changed_digests[name] = digest
+
+    @contextlib.contextmanager
+    def open(self, name: str, mode: str = 'w') -> Generator[IO[Any], None, None]:
+        """Open an output for writing, in text ('w') or binary ('wb') mode."""
+        assert mode in ('w', 'wb'), mode
+        binary = mode == 'wb'
+        compressors = [] if binary else self.compressors
+        if self.streams_to_files and not self.skip_unchanged and not compressors and self.changes is None:
+            path = self._path(name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with atomic_write(path, mode) as f:
+                yield f
+                self.bytes_written += f.tell()
+            self.written += 1
+            return
+
+        # Text is encoded as it's written, so that only the encoded output is
+        # kept in memory (rather than a str and then its encoded copy).
+        raw = io.BytesIO()
+        buf: IO[Any] = raw if binary else io.TextIOWrapper(raw, encoding='utf-8', newline='')
+        yield buf
+        buf.flush()
+        data = raw.getvalue()
+        digest = hashlib.sha256(data).hexdigest()
+        if self.skip_unchanged:
+            existing_digest = self._existing_digest(name)
+            unchanged = digest == existing_digest
+            self._set_digest(name, digest)
+        else:
+            existing_digest = None
+            unchanged = False
 
+        if unchanged:
+            self.skipped += 1
+        else:
+            if self.changes is not None:
+                existed = existing_digest is not None if self.skip_unchanged else self._exists(name)
+                self.changes.append((name, 'modified' if existed else 'created', digest))
+            self._write(name, data)
+            self.written += 1
+            self.bytes_written += len(data)
+        for extension, compress in compressors:
+            existed = self._exists(name + extension)
+            # Even for an unchanged output, the compressed copy might be
+            # missing (e.g. when compression was only just turned on).
+            if not unchanged or not existed:
+                compressed = compress(data)
+                if self.changes is not None:
+                    self.changes.append((
+                        name + extension,
+                        'modified' if existed else 'created',
+                        hashlib.sha256(compressed).hexdigest(),
+                    ))
+                self._write(name + extension, compressed)
+
+    def remove(self, name: str) -> None:
+        """Remove an output, along with its compressed copies."""
+        for extension in ('', *(extension for extension, _ in self.compressors)):
+            self._delete(name + extension)
+            if self.changes is not None:
+                self.changes.append((name + extension, 'deleted', None))
+        self._set_digest(name, None)
+
+    def flush(self) -> None:
+        """Wait for any writes which are still in progress."""
+
+    def result(self) -> _WriterResult:
+        return self.written, self.skipped, self.bytes_written, self.changed_digests, self.changes or [], []
+
+    def merge(
+            self,
+            written: int,
+            skipped: int,
+            bytes_written: int,
+            changed_digests: dict[str, str | None],
+            changes: list[tuple[str, str, str | None]],
+            outputs: list[tuple[str, bytes | None]],
+    ) -> None:
+        """Merge in the result() of a writer from a worker process."""
+        self.written += written
+        self.skipped += skipped
+        self.bytes_written += bytes_written
+        for name, digest in changed_digests.items():
+            self._set_digest(name, digest)
+        if self.changes is not None:
+            self.changes.extend(changes)
+        # Files written (or deleted, as None) by a worker which couldn't write
+        # them itself.
+        for name, data in outputs:
+            if data is None:
+                self._delete(name)
+            else:
+                self._write(name, data)
 
-def build_repo(
-        packages: dict[str, set[Package]],
-        previous_packages: dict[str, set[Package]] | None,
+
+class _WriteOnlyWriter(_Writer):
+    """Base class for writers whose previous outputs can't be read back (or
+    cheaply checked), e.g. in a tar archive or an S3 bucket.
+    """
+
+    streams_to_files = False
+
+    def __init__(
+            self,
+            *,
+            skip_unchanged: bool = False,
+            digests: dict[str, str] | None = None,
+            gzip_level: int | None = None,
+            brotli_quality: int | None = None,
+            record_changes: bool = False,
+    ) -> None:
+        super().__init__(
+            '',
+            skip_unchanged=skip_unchanged,
+            digests=digests,
+            gzip_level=gzip_level,
+            brotli_quality=brotli_quality,
+            record_changes=record_changes,
+        )
+
+    def _exists(self, name: str) -> bool:
+        # This trusts the stored digests, and doesn't add compressed copies of
+        # unchanged outputs.
+        return True
+
+    def _read(self, name: str) -> bytes | None:
+        return None
+
+
+class _TarWriter(_WriteOnlyWriter):
+    """Writes build outputs into a tar archive instead of a directory.
+
+    Files can't be deleted from a tar, so deleted files are only recorded (in
+    `deleted`). Without a tar (in worker processes), the files are collected
+    and returned by result() so that the parent can write them.
+    """
+
+    def __init__(
+            self,
+            tar: tarfile.TarFile | None,
+            *,
+            skip_unchanged: bool = False,
+            digests: dict[str, str] | None = None,
+            gzip_level: int | None = None,
+            brotli_quality: int | None = None,
+            record_changes: bool = False,
+    ) -> None:
+        super().__init__(
+            skip_unchanged=skip_unchanged,
+            digests=digests,
+            gzip_level=gzip_level,
+            brotli_quality=brotli_quality,
+            record_changes=record_changes,
+        )
+        self.tar = tar
+        self.mtime = int(time.time())
+        self.outputs: list[tuple[str, bytes | None]] = []
+        self.deleted: list[str] = []
+
+    def _write(self, name: str, data: bytes) -> None:
+        if self.tar is None:
+            self.outputs.append((name, data))
+            return
+        import tarfile
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mtime = self.mtime
+        info.mode = 0o644
+        self.tar.addfile(info, io.BytesIO(data))
+
+    def _delete(self, name: str) -> None:
+        if self.tar is None:
+            self.outputs.append((name, None))
+        else:
+            self.deleted.append(name)
+
+    def result(self) -> _WriterResult:
+        return self.written, self.skipped, self.bytes_written, self.changed_digests, self.changes or [], self.outputs
+
+
+def _tar_compression(path: str) -> str | None:
+    """Guess the compression for --output-tar from its extension."""
+    if path.endswith(('.tar.gz', '.tgz')):
+        return 'gzip'
+    elif path.endswith(('.tar.zst', '.tzst')):
+        return 'zstd'
+    else:
+        return None
+
+
+@contextlib.contextmanager
+def _open_tar(path: str, compression: str | None) -> Generator[tarfile.TarFile, None, None]:
+    """Open a tar archive for streaming into (use - for stdout)."""
+    import tarfile
+    with contextlib.ExitStack() as ctx:
+        f: IO[bytes] = sys.stdout.buffer if path == '-' else ctx.enter_context(atomic_write(path, 'wb'))
+        if compression == 'gzip':
+            yield ctx.enter_context(tarfile.open(fileobj=f, mode='w|gz'))
+        else:
+            if compression == 'zstd':
+                import zstandard
+                f = ctx.enter_context(zstandard.ZstdCompressor().stream_writer(f, closefd=False))
+            yield ctx.enter_context(tarfile.open(fileobj=f, mode='w|'))
+
+
+def _content_type(name: str) -> str:
+    """The Content-Type to serve an output with."""
+    if name.endswith('.html'):
+        return 'text/html; charset=utf-8'
+    elif name.startswith('simple/') and name.endswith('index.json'):
+        return SIMPLE_JSON_CONTENT_TYPE
+    elif name.endswith('json'):
+        return 'application/json'
+    elif name.endswith('.gz'):
+        return 'application/gzip'
+    else:
+        return 'application/octet-stream'
+
+
+def _parse_s3_url(url: str) -> tuple[str, str]:
+    """Split an s3://bucket/prefix URL into the bucket and key prefix."""
+    scheme, _, rest = url.partition('://')
+    bucket, _, prefix = rest.partition('/')
+    if scheme != 's3' or not bucket:
+        raise ValueError(f'Not an s3://bucket/prefix URL: {url}')
+    prefix = prefix.strip('/')
+    return bucket, f'{prefix}/' if prefix else ''
+
+
+class _S3Writer(_WriteOnlyWriter):
+    """Uploads build outputs to an S3-compatible object store.
+
+    Only the outputs which are written (or removed) are uploaded (or
+    deleted), in the background over a pool of `max_connections`
+    connections. At most twice that many uploads are queued at once, so
+    rendering can't get too far ahead. close() waits for them to finish and
+    raises the first error, if any.
+    """
+
+    def __init__(
+            self,
+            url: str,
+            *,
+            endpoint_url: str | None = None,
+            max_connections: int = 16,
+            skip_unchanged: bool = False,
+            digests: dict[str, str] | None = None,
+            gzip_level: int | None = None,
+            brotli_quality: int | None = None,
+            record_changes: bool = False,
+    ) -> None:
+        super().__init__(
+            skip_unchanged=skip_unchanged,
+            digests=digests,
+            gzip_level=gzip_level,
+            brotli_quality=brotli_quality,
+            record_changes=record_changes,
+        )
+        import concurrent.futures
+        import threading
+
+        import boto3
+        import botocore.config
+        self.bucket, self.prefix = _parse_s3_url(url)
+        self.client = boto3.session.Session().client(
+            's3',
+            endpoint_url=endpoint_url,
+            config=botocore.config.Config(max_pool_connections=max_connections),
+        )
+        self.max_connections = max_connections
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_connections)
+        self.queued = threading.BoundedSemaphore(max_connections * 2)
+        self.errors: list[BaseException] = []
+
+    def _submit(self, fn: Callable[..., Any], **kwargs: Any) -> None:
+        self.queued.acquire()
+        future = self.executor.submit(fn, Bucket=self.bucket, **kwargs)
+        future.add_done_callback(self._done)
+
+    def _done(self, future: concurrent.futures.Future[Any]) -> None:
+        self.queued.release()
+        error = future.exception()
+        if error is not None:
+            self.errors.append(error)
+
+    def _write(self, name: str, data: bytes) -> None:
+        self._submit(
+            self.client.put_object,
+            Key=self.prefix + name,
+            Body=data,
+            ContentType=_content_type(name),
+        )
+
+    def _delete(self, name: str) -> None:
+        self._submit(self.client.delete_object, Key=self.prefix + name)
+
+    def flush(self) -> None:
+        # Once every slot in the queue can be taken, nothing is in progress.
+        for _ in range(self.max_connections * 2):
+            self.queued.acquire()
+        for _ in range(self.max_connections * 2):
+            self.queued.release()
+
+    def close(self) -> None:
+        self.executor.shutdown()
+        if self.errors:
+            raise self.errors[0]
+
+
+@contextlib.contextmanager
+def _open_writer(
         settings: Settings,
-) -> None:
-    simple = os.path.join(settings.output_dir, 'simple')
-    pypi = os.path.join(settings.output_dir, 'pypi')
-    current_date = _format_datetime(datetime.utcnow())
+        digests: dict[str, str] | None,
+        *,
+        in_worker: bool = False,
+) -> Generator[_Writer, None, None]:
+    """Open a writer for the output chosen in settings.
+
+    A worker process can't write into the parent's tar archive, so its writer
+    returns the outputs from result() for the parent to write instead. The
+    --s3-max-connections budget is split between the worker processes.
+    """
+    options: dict[str, Any] = {
+        'skip_unchanged': settings.skip_unchanged,
+        'digests': digests,
+        'gzip_level': settings.gzip_level,
+        'brotli_quality': settings.brotli_quality,
+        'record_changes': settings.manifest is not None,
+    }
+    if settings.output_s3 is not None:
+        max_connections = settings.s3_max_connections
+        if in_worker:
+            max_connections = max(1, max_connections // settings.jobs)
+        s3_writer = _S3Writer(
+            settings.output_s3,
+            endpoint_url=settings.s3_endpoint_url,
+            max_connections=max_connections,
+            **options,
+        )
+        try:
+            yield s3_writer
+        except BaseException:
+            # Wait for the uploads, but don't hide the error with one of theirs.
+            with contextlib.suppress(Exception):
+                s3_writer.close()
+            raise
+        else:
+            s3_writer.close()
+    elif settings.output_tar is None:
+        yield _Writer(settings.output_dir, **options)
+    elif in_worker:
+        yield _TarWriter(None, **options)
+    else:
+        with _open_tar(settings.output_tar, settings.output_tar_compression) as tar:
+            tar_writer = _TarWriter(tar, **options)
+            yield tar_writer
+        if tar_writer.deleted:
+            print(
+                f'{len(tar_writer.deleted)} outputs were removed, which the tar archive '
+                f'can\'t include: {", ".join(tar_writer.deleted)}',
+                file=sys.stderr,
+            )
+
+
+class _Timings:
+    """Wall and CPU time spent in each phase of a build, for --timings."""
+
+    def __init__(self) -> None:
+        self.start = (time.perf_counter(), time.process_time())
+        self.phases: dict[str, dict[str, float]] = {}
+        self.package_times: list[tuple[float, str]] = []
+        # CPU time used by worker processes, which isn't included in the
+        # process_time() of this process.
+        self.worker_cpu = 0.0
+        self.counts: dict[str, int] = {}
+
+    @contextlib.contextmanager
+    def phase(self, name: str) -> Generator[None, None, None]:
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            timing = self.phases.setdefault(name, {'wall': 0.0, 'cpu': 0.0})
+            timing['wall'] += time.perf_counter() - wall
+            timing['cpu'] += time.process_time() - cpu
+
+    def merge_phases(self, phases: dict[str, dict[str, float]]) -> None:
+        """Add the phase timings of a worker process."""
+        for name, worker_timing in phases.items():
+            timing = self.phases.setdefault(name, {'wall': 0.0, 'cpu': 0.0})
+            timing['wall'] += worker_timing['wall']
+            timing['cpu'] += worker_timing['cpu']
+
+    def report(self, slowest: int) -> dict[str, Any]:
+        wall, cpu = self.start
+        return {
+            'total': {'wall': time.perf_counter() - wall, 'cpu': time.process_time() - cpu},
+            'phases': self.phases,
+            'worker_cpu': self.worker_cpu,
+            **self.counts,
+            'slowest_packages': [
+                {'name': name, 'wall': seconds}
+                for seconds, name in sorted(self.package_times, reverse=True)[:slowest]
+            ],
+        }
+
 
+def _load_digests(path: str) -> dict[str, str]:
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+# Cached so that repeated builds (e.g. with --watch) reuse the compiled
+# templates.
+@functools.lru_cache(maxsize=None)
+def _jinja_env(settings: Settings) -> jinja2.Environment:
+    import jinja2
+    bytecode_cache = None
+    if settings.cache_dir:
+        # Compiling the templates is a noticeable part of small builds, so
+        # keep the compiled templates between runs.
+        bytecode_cache_dir = os.path.join(settings.cache_dir, 'jinja')
+        os.makedirs(bytecode_cache_dir, exist_ok=True)
+        bytecode_cache = jinja2.FileSystemBytecodeCache(bytecode_cache_dir)
     jinja_env = jinja2.Environment(
         loader=jinja2.PackageLoader('dumb_pypi', 'templates'),
         autoescape=True,
+        bytecode_cache=bytecode_cache,
     )
     jinja_env.globals['title'] = settings.title
     jinja_env.globals['packages_url'] = settings.packages_url
     jinja_env.globals['logo'] = settings.logo
     jinja_env.globals['logo_width'] = settings.logo_width
+    return jinja_env
 
-    # Short circuit if nothing changed at all.
-    if packages == previous_packages:
-        return
 
-    # Sorting package versions is actually pretty expensive, so we do it once
-    # at the start.
-    sorted_packages = {name: sorted(files) for name, files in packages.items()}
-
-    # /simple/index.html
-    # Rebuild if there are different package names.
-    if previous_packages is None or set(packages) != set(previous_packages):
-        os.makedirs(simple, exist_ok=True)
-        with atomic_write(os.path.join(simple, 'index.html')) as f:
-            f.write(jinja_env.get_template('simple.html').render(
-                date=current_date,
-                generate_timestamp=settings.generate_timestamp,
-                package_names=sorted(sorted_packages),
-            ))
+def _group_by_version(files: Iterable[Package]) -> dict[str | None, list[Package]]:
+    by_version: dict[str | None, list[Package]] = collections.defaultdict(list)
+    for file_ in files:
+        by_version[file_.version].append(file_)
+    return by_version
 
-    for package_name, sorted_files in sorted_packages.items():
-        # Rebuild if the files are different for this package.
-        if previous_packages is None or previous_packages[package_name] != packages[package_name]:
-            latest_version = sorted_files[-1].version
-
-            # /simple/{package}/index.html
-            simple_package_dir = os.path.join(simple, package_name)
-            os.makedirs(simple_package_dir, exist_ok=True)
-            with atomic_write(os.path.join(simple_package_dir, 'index.html')) as f:
-                f.write(jinja_env.get_template('package.html').render(
-                    date=current_date,
-                    generate_timestamp=settings.generate_timestamp,
-                    package_name=package_name,
-                    files=sorted_files,
-                    packages_url=settings.packages_url,
-                    requirement=f'{package_name}=={latest_version}' if latest_version else package_name,
-                ))
-
-            # /pypi/{package}/json
-            pypi_package_dir = os.path.join(pypi, package_name)
-            os.makedirs(pypi_package_dir, exist_ok=True)
-            with atomic_write(os.path.join(pypi_package_dir, 'json')) as f:
-                json.dump(_package_json(sorted_files, settings.packages_url), f)
-
-            # /pypi/{package}/{version}/json
-            if not settings.disable_per_release_json:
-                # TODO: Consider making this only generate JSON for the changed versions.
-                version_to_files = collections.defaultdict(list)
-                for file_ in sorted_files:
-                    version_to_files[file_.version].append(file_)
-                for version, files in version_to_files.items():
-                    if version is None:
-                        continue
-                    version_dir = os.path.join(pypi_package_dir, version)
-                    os.makedirs(version_dir, exist_ok=True)
-                    with atomic_write(os.path.join(version_dir, 'json')) as f:
-                        json.dump(_package_json(files, settings.packages_url), f)
-
-    # /changelog
-    # Always rebuild (we would have short circuited already if nothing changed).
-    changelog = os.path.join(settings.output_dir, 'changelog')
-    os.makedirs(changelog, exist_ok=True)
-    files_newest_first = sorted(
-        itertools.chain.from_iterable(packages.values()),
-        key=lambda package: (-(package.upload_timestamp or 0), package),
-    )
-    page_count = math.ceil(len(files_newest_first) / CHANGELOG_ENTRIES_PER_PAGE)
-    for page_idx, start_idx in enumerate(range(0, len(files_newest_first), CHANGELOG_ENTRIES_PER_PAGE)):
-        chunk = files_newest_first[start_idx:start_idx + CHANGELOG_ENTRIES_PER_PAGE]
-        page_number = page_idx + 1
-        with atomic_write(os.path.join(changelog, f'page{page_number}.html')) as f:
-            pagination_first = "page1.html" if page_number != 1 else None
-            pagination_last = f"page{page_count}.html" if page_number != page_count else None
-            pagination_prev = f"page{page_number - 1}.html" if page_number != 1 else None
-            pagination_next = f"page{page_number + 1}.html" if page_number != page_count else None
-            f.write(jinja_env.get_template('changelog.html').render(
-                files_newest_first=chunk,
+
+def _build_simple_package_page(
+        package_name: str,
+        sorted_files: list[Package],
+        settings: Settings,
+        writer: _Writer,
+        jinja_env: jinja2.Environment,
+        current_date: str,
+) -> None:
+    # /simple/{package}/index.html
+    latest_version = sorted_files[-1].version
+    with writer.open(f'simple/{package_name}/index.html') as f:
+        jinja_env.get_template('package.html').stream(
+            date=current_date,
+            generate_timestamp=settings.generate_timestamp,
+            package_name=package_name,
+            files=sorted_files,
+            packages_url=settings.packages_url,
+            requirement=f'{package_name}=={latest_version}' if latest_version else package_name,
+        ).dump(f)
+
+    # /simple/{package}/index.json
+    if settings.simple_json:
+        with writer.open(f'simple/{package_name}/index.json') as f:
+            json.dump(
+                {
+                    'meta': SIMPLE_JSON_META,
+                    'name': package_name,
+                    'files': [file_.simple_json_info(settings.packages_url) for file_ in sorted_files],
+                    'versions': list(dict.fromkeys(
+                        file_.version for file_ in sorted_files if file_.version is not None
+                    )),
+                },
+                f,
+            )
+
+
+def _build_package_json(
+        package_name: str,
+        sorted_files: list[Package],
+        previous_files: set[Package] | None,
+        settings: Settings,
+        writer: _Writer,
+) -> None:
+    # /pypi/{package}/json
+    with writer.open(f'pypi/{package_name}/json') as f:
+        json.dump(_package_json(sorted_files, settings.packages_url), f)
+
+    # /pypi/{package}/{version}/json
+    # Only versions whose files changed since the previous build are rebuilt,
+    # and versions which no longer have any files are removed.
+    if not settings.disable_per_release_json:
+        version_to_files = _group_by_version(sorted_files)
+        previous_version_to_files = _group_by_version(previous_files or ())
+        for version, files in version_to_files.items():
+            if version is None or set(files) == set(previous_version_to_files.get(version, ())):
+                continue
+            with writer.open(f'pypi/{package_name}/{version}/json') as f:
+                json.dump(_package_json(files, settings.packages_url), f)
+        for version in previous_version_to_files.keys() - version_to_files.keys():
+            if version is None:
+                continue
+            writer.remove(f'pypi/{package_name}/{version}/json')
+
+
+def _build_package(
+        package_name: str,
+        sorted_files: list[Package],
+        previous_files: set[Package] | None,
+        settings: Settings,
+        writer: _Writer,
+        jinja_env: jinja2.Environment,
+        current_date: str,
+        timings: _Timings,
+) -> None:
+    start = time.perf_counter()
+    with timings.phase('simple_pages'):
+        _build_simple_package_page(package_name, sorted_files, settings, writer, jinja_env, current_date)
+    with timings.phase('json_api'):
+        _build_package_json(package_name, sorted_files, previous_files, settings, writer)
+    timings.package_times.append((time.perf_counter() - start, package_name))
+
+
+def _remove_package(
+        package_name: str,
+        previous_files: set[Package],
+        settings: Settings,
+        writer: _Writer,
+) -> None:
+    """Remove the outputs of a package which is no longer in the package list."""
+    writer.remove(f'simple/{package_name}/index.html')
+    if settings.simple_json:
+        writer.remove(f'simple/{package_name}/index.json')
+    writer.remove(f'pypi/{package_name}/json')
+    if settings.reverse_dependencies:
+        writer.remove(f'pypi/{package_name}/dependents.json')
+    if not settings.disable_per_release_json:
+        for version in sorted({file_.version for file_ in previous_files if file_.version is not None}):
+            writer.remove(f'pypi/{package_name}/{version}/json')
+
+
+# Per-process state for worker processes, set up once by `_init_worker` so
+# that each chunk of packages doesn't need to rebuild the Jinja environment.
+_worker_state: tuple[Settings, jinja2.Environment, str, dict[str, str] | None] | None = None
+
+
+def _init_worker(settings: Settings, current_date: str, digests: dict[str, str] | None) -> None:
+    global _worker_state
+    _worker_state = (settings, _jinja_env(settings), current_date, digests)
+
+
+def _build_packages_chunk(
+        chunk: list[tuple[str, list[Package], set[Package] | None]],
+) -> tuple[_WriterResult, list[tuple[float, str]], dict[str, dict[str, float]], float]:
+    """Build a chunk of packages in a worker process.
+
+    Returns the writer's result(), the time spent on each package, the time
+    spent in each phase, and the CPU time used by the worker.
+    """
+    assert _worker_state is not None
+    settings, jinja_env, current_date, digests = _worker_state
+    cpu = time.process_time()
+    timings = _Timings()
+    with _open_writer(settings, digests, in_worker=True) as writer:
+        for package_name, sorted_files, previous_files in chunk:
+            _build_package(
+                package_name, sorted_files, previous_files, settings, writer, jinja_env, current_date, timings,
+            )
+    return writer.result(), timings.package_times, timings.phases, time.process_time() - cpu
+
+
+def _chunks(items: list[Any], chunk_size: int) -> Iterator[list[Any]]:
+    for i in range(0, len(items), chunk_size):
+        yield items[i:i + chunk_size]
+
+
+def _build_packages(
+        changed_packages: list[tuple[str, list[Package], set[Package] | None]],
+        settings: Settings,
+        writer: _Writer,
+        jinja_env: jinja2.Environment,
+        current_date: str,
+        timings: _Timings,
+) -> None:
+    if settings.jobs <= 1 or len(changed_packages) <= 1:
+        for package_name, sorted_files, previous_files in changed_packages:
+            _build_package(
+                package_name, sorted_files, previous_files, settings, writer, jinja_env, current_date, timings,
+            )
+        return
+
+    # Hand out several chunks per worker so that a few very large packages
+    # don't leave the other workers idle at the end, while still keeping the
+    # number of round trips to the pool small.
+    chunk_size = math.ceil(len(changed_packages) / (settings.jobs * 4))
+    # The workers get the parent's share of e.g. the S3 connections.
+    writer.flush()
+    import concurrent.futures
+    import multiprocessing
+    # Start the workers with spawn rather than fork: forking while another
+    # thread (e.g. one of the S3 writer's uploads) holds a lock leaves that
+    # lock held forever in the child.
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=settings.jobs,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=_init_worker,
+            initargs=(settings, current_date, writer.digests),
+    ) as executor:
+        chunks = _chunks(changed_packages, chunk_size)
+        for result, package_times, phases, cpu in executor.map(_build_packages_chunk, chunks):
+            writer.merge(*result)
+            timings.package_times.extend(package_times)
+            timings.merge_phases(phases)
+            timings.worker_cpu += cpu
+
+
+def _changelog_key(package: Package) -> tuple[int, tuple[Any, ...]]:
+    return (-(package.upload_timestamp or 0), package.sort_key)
+
+
+def _build_changelog(
+        sorted_packages: dict[str, list[Package]],
+        previous_packages: dict[str, set[Package]] | None,
+        writer: _Writer,
+        jinja_env: jinja2.Environment,
+) -> None:
+    """Write the changelog pages.
+
+    Pages are numbered starting from the oldest files, so page1.html always
+    holds the oldest entries and a new upload only changes the newest page.
+    The newest page is also written to index.html as the changelog's landing
+    page. On partial rebuilds, only the pages at or after the oldest changed
+    entry are rewritten.
+    """
+    # This is the same order as sorting by _changelog_key, but much cheaper:
+    # the files are already sorted within each package, so a stable sort by
+    # upload time of the files in package name order only needs to compare
+    # the timestamps.
+    files_newest_first = [
+        file_
+        for package_name in sorted(sorted_packages)
+        for file_ in sorted_packages[package_name]
+    ]
+    files_newest_first.sort(key=lambda package: -(package.upload_timestamp or 0))
+    file_count = len(files_newest_first)
+    page_count = math.ceil(file_count / CHANGELOG_ENTRIES_PER_PAGE)
+
+    first_page = 1
+    # Before the pages were numbered from the oldest files, page1.html held
+    # the newest files and there was no index.html. Every page of a
+    # changelog built like that is in the wrong place, so rebuild them all.
+    if previous_packages is not None and writer._exists('changelog/index.html'):
+        previous_files = set(itertools.chain.from_iterable(previous_packages.values()))
+        changed_files = previous_files.symmetric_difference(files_newest_first)
+        previous_page_count = math.ceil(len(previous_files) / CHANGELOG_ENTRIES_PER_PAGE)
+        # Every file older than the oldest changed file is at the same position
+        # in both the old and new changelog, so the pages holding only those
+        # files are unchanged. (There is at least one changed file, otherwise
+        # build_repo would have short circuited.)
+        oldest_changed = max(map(_changelog_key, changed_files))
+        # Binary search for the first of those older files.
+        lo, hi = 0, file_count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if _changelog_key(files_newest_first[mid]) > oldest_changed:
+                hi = mid
+            else:
+                lo = mid + 1
+        unchanged_count = file_count - lo
+        first_page = unchanged_count // CHANGELOG_ENTRIES_PER_PAGE + 1
+        if page_count != previous_page_count:
+            # The pagination links of the previously newest page change.
+            first_page = max(min(first_page, page_count, previous_page_count), 1)
+        for page_number in range(page_count + 1, previous_page_count + 1):
+            writer.remove(f'changelog/page{page_number}.html')
+        if page_count == 0:
+            # There's no newest page to write to index.html any more.
+            writer.remove('changelog/index.html')
+
+    for page_number in range(first_page, page_count + 1):
+        start_idx = max(file_count - page_number * CHANGELOG_ENTRIES_PER_PAGE, 0)
+        end_idx = file_count - (page_number - 1) * CHANGELOG_ENTRIES_PER_PAGE
+        page_names = [f'page{page_number}.html']
+        if page_number == page_count:
+            page_names.append('index.html')
+        # The page is streamed into each of its names at once, rather than
+        # rendered into one big string first.
+        with contextlib.ExitStack() as ctx:
+            files = [ctx.enter_context(writer.open(f'changelog/{page_name}')) for page_name in page_names]
+            for chunk in jinja_env.get_template('changelog.html').generate(
+                files_newest_first=files_newest_first[start_idx:end_idx],
                 page_number=page_number,
-                page_count=page_count,
-                pagination_first=pagination_first,
-                pagination_last=pagination_last,
-                pagination_prev=pagination_prev,
-                pagination_next=pagination_next,
+                pagination_first='index.html' if page_number != page_count else None,
+                pagination_prev=f'page{page_number + 1}.html' if page_number != page_count else None,
+                pagination_next=f'page{page_number - 1}.html' if page_number != 1 else None,
+                pagination_last='page1.html' if page_number != 1 else None,
+            ):
+                for f in files:
+                    f.write(chunk)
+
+
+_sort_key = operator.attrgetter('sort_key')
+
+
+def _sort_files(files: Iterable[Package]) -> list[Package]:
+    # Computing the sort key once per file (rather than twice per comparison,
+    # as Package.__lt__ does) makes this several times faster.
+    return sorted(files, key=_sort_key)
+
+
+def _sort_packages(
+        packages: dict[str, set[Package]],
+        previous_sorted_packages: dict[str, list[Package]] | None = None,
+) -> dict[str, list[Package]]:
+    """Sort the files of each package.
+
+    When the sorted files of the previous build are available, unchanged
+    packages reuse them and changed packages only need to sort the new files,
+    which are merged into the previous files that are still around.
+    """
+    if previous_sorted_packages is None:
+        return {name: _sort_files(files) for name, files in packages.items()}
+
+    sorted_packages = {}
+    for name, files in packages.items():
+        previous_sorted = previous_sorted_packages.get(name, [])
+        if len(previous_sorted) == len(files) and files.issuperset(previous_sorted):
+            sorted_packages[name] = previous_sorted
+        else:
+            sorted_packages[name] = list(heapq.merge(
+                [file_ for file_ in previous_sorted if file_ in files],
+                _sort_files(files.difference(previous_sorted)),
+                key=_sort_key,
             ))
+    return sorted_packages
+
 
-    # /index.html
-    # Always rebuild (we would have short circuited already if nothing changed).
-    with atomic_write(os.path.join(settings.output_dir, 'index.html')) as f:
-        f.write(jinja_env.get_template('index.html').render(
-            packages=sorted(
-                (
-                    package,
-                    sorted_versions[-1].version,
-                )
-                for package, sorted_versions in sorted_packages.items()
-            ),
-        ))
-
-    # /packages.json
-    # Always rebuild (we would have short circuited already if nothing changed).
-    with atomic_write(os.path.join(settings.output_dir, 'packages.json')) as f:
+def _changed_packages(
+        packages: dict[str, set[Package]],
+        sorted_packages: dict[str, list[Package]],
+        previous_packages: dict[str, set[Package]] | None,
+) -> list[tuple[str, list[Package], set[Package] | None]]:
+    """Return (name, sorted files, previous files) for each changed package."""
+    if previous_packages is None:
+        return [(name, sorted_files, None) for name, sorted_files in sorted_packages.items()]
+    return [
+        (name, sorted_files, previous_packages.get(name))
+        for name, sorted_files in sorted_packages.items()
+        if previous_packages.get(name) != packages[name]
+    ]
+
+
+def _build_simple_index(
+        sorted_packages: dict[str, list[Package]],
+        settings: Settings,
+        writer: _Writer,
+        jinja_env: jinja2.Environment,
+        current_date: str,
+) -> None:
+    with writer.open('simple/index.html') as f:
+        jinja_env.get_template('simple.html').stream(
+            date=current_date,
+            generate_timestamp=settings.generate_timestamp,
+            package_names=sorted(sorted_packages),
+        ).dump(f)
+
+    # /simple/index.json
+    if settings.simple_json:
+        with writer.open('simple/index.json') as f:
+            json.dump(
+                {
+                    'meta': SIMPLE_JSON_META,
+                    'projects': [{'name': package_name} for package_name in sorted(sorted_packages)],
+                },
+                f,
+            )
+
+
+def _build_dependents(
+        sorted_packages: dict[str, list[Package]],
+        previous_packages: dict[str, set[Package]] | None,
+        changed_packages: list[tuple[str, list[Package], set[Package] | None]],
+        writer: _Writer,
+) -> None:
+    # /pypi/{package}/dependents.json
+    dependents = _reverse_dependencies(sorted_packages)
+    if previous_packages is None:
+        package_names: Iterable[str] = sorted_packages
+    else:
+        # Only the dependents of projects which changed (or removed) packages
+        # depend on, or used to, can have changed. New packages need their
+        # (possibly empty) dependents written too.
+        affected = set()
+        for _, sorted_files, previous_files in changed_packages:
+            affected |= _dependency_names(sorted_files)
+            if previous_files:
+                affected |= _dependency_names(sorted(previous_files, key=_sort_key))
+        for package_name in previous_packages.keys() - sorted_packages.keys():
+            affected |= _dependency_names(sorted(previous_packages[package_name], key=_sort_key))
+        package_names = [
+            package_name for package_name in sorted_packages
+            if package_name not in previous_packages or _canonicalize_name(package_name) in affected
+        ]
+
+    for package_name in sorted(package_names):
+        with writer.open(f'pypi/{package_name}/dependents.json') as f:
+            json.dump(
+                {
+                    'dependents': sorted(
+                        dependents.get(_canonicalize_name(package_name), ()),
+                        key=operator.itemgetter('name'),
+                    ),
+                },
+                f,
+            )
+
+
+def _bulk_shard(package_name: str) -> str:
+    """The bulk/{shard}.json file a package is in: the first two hex digits
+    of the SHA-256 of its canonical name."""
+    return hashlib.sha256(_canonicalize_name(package_name).encode()).hexdigest()[:2]
+
+
+def _build_bulk_json(
+        sorted_packages: dict[str, list[Package]],
+        previous_packages: dict[str, set[Package]] | None,
+        changed_packages: list[tuple[str, list[Package], set[Package] | None]],
+        settings: Settings,
+        writer: _Writer,
+) -> None:
+    # /bulk/{shard}.json
+    # The pypi/{package}/json of many packages at once, so that mirrors can
+    # fetch all of them in 256 requests. Every shard is written (even if it's
+    # empty) so that they can be fetched without knowing the package names.
+    shards: dict[str, list[str]] = collections.defaultdict(list)
+    for package_name in sorted_packages:
+        shards[_bulk_shard(package_name)].append(package_name)
+    if previous_packages is None:
+        changed_shards = {f'{shard:02x}' for shard in range(256)}
+    else:
+        changed_shards = {_bulk_shard(package_name) for package_name, _, _ in changed_packages}
+        changed_shards.update(map(_bulk_shard, previous_packages.keys() - sorted_packages.keys()))
+    for shard in sorted(changed_shards):
+        with writer.open(f'bulk/{shard}.json') as f:
+            json.dump(
+                {
+                    package_name: _package_json(sorted_packages[package_name], settings.packages_url)
+                    for package_name in sorted(shards[shard])
+                },
+                f,
+            )
+
+    # /latest.json
+    with writer.open('latest.json') as f:
+        json.dump(
+            {package_name: sorted_packages[package_name][-1].version for package_name in sorted(sorted_packages)},
+            f,
+        )
+
+
+def _build_index(
+        sorted_packages: dict[str, list[Package]],
+        writer: _Writer,
+        jinja_env: jinja2.Environment,
+) -> None:
+    with writer.open('index.html') as f:
+        jinja_env.get_template('index.html').stream(
+            package_count=len(sorted_packages),
+        ).dump(f)
+
+
+def _build_search_index(sorted_packages: dict[str, list[Package]], writer: _Writer) -> None:
+    # The index page searches these client-side, rather than rendering (and
+    # filtering) an element for every package.
+    with writer.open('search.json') as f:
+        json.dump(
+            [
+                (package_name, sorted_packages[package_name][-1].version)
+                for package_name in sorted(sorted_packages)
+            ],
+            f,
+            separators=(',', ':'),
+        )
+
+
+def _latest_versions_changed(changed_packages: list[tuple[str, list[Package], set[Package] | None]]) -> bool:
+    return any(
+        previous_files is None or sorted_files[-1].version != max(previous_files).version
+        for _, sorted_files, previous_files in changed_packages
+    )
+
+
+def _build_packages_json(sorted_packages: dict[str, list[Package]], writer: _Writer) -> None:
+    with writer.open('packages.json') as f:
         for package in itertools.chain.from_iterable(sorted_packages.values()):
             f.write(f'{json.dumps(package.input_json())}\n')
 
 
-def _lines_from_path(path: str) -> list[str]:
-    f = sys.stdin if path == '-' else open(path)
-    return f.read().splitlines()
+def _write_manifest(path: str, manifest_format: str, changes: list[tuple[str, str, str | None]]) -> None:
+    """Write the files a build created, modified or deleted, for --manifest."""
+    with atomic_write(path) as f:
+        for name, action, digest in sorted(changes):
+            if manifest_format == 'text':
+                f.write(f'{action} {digest or "-"} {name}\n')
+            else:
+                f.write(f'{json.dumps({"path": name, "action": action, "sha256": digest})}\n')
+
+
+def build_repo(
+        packages: dict[str, set[Package]],
+        previous_packages: dict[str, set[Package]] | None,
+        settings: Settings,
+        *,
+        previous_sorted_packages: dict[str, list[Package]] | None = None,
+        timings: _Timings | None = None,
+) -> None:
+    """Build the registry into settings.output_dir (or the tar archive or S3
+    bucket chosen in settings).
+
+    If already sorted files of each package (e.g. from the previous build)
+    are passed as previous_sorted_packages, they are reused for packages whose
+    files are unchanged instead of sorting every package again.
+    """
+    # Short circuit if nothing changed at all.
+    if packages == previous_packages:
+        if settings.output_tar is not None:
+            # Still write an (empty) archive, for whatever consumes it.
+            with _open_tar(settings.output_tar, settings.output_tar_compression):
+                pass
+        if settings.manifest:
+            _write_manifest(settings.manifest, settings.manifest_format, [])
+        return
+
+    timings = timings or _Timings()
+    current_date = _format_datetime(datetime.utcnow())
+    with timings.phase('jinja_env'):
+        jinja_env = _jinja_env(settings)
+
+    digests = _load_digests(settings.digest_file) if settings.digest_file else None
+    with _open_writer(settings, digests) as writer:
+        # Sorting package versions is actually pretty expensive, so we do it once
+        # at the start.
+        with timings.phase('sort'):
+            sorted_packages = _sort_packages(packages, previous_sorted_packages)
+
+        names_changed = previous_packages is None or packages.keys() != previous_packages.keys()
+
+        # /simple/index.html
+        # Rebuild if there are different package names.
+        with timings.phase('simple_index'):
+            if names_changed:
+                _build_simple_index(sorted_packages, settings, writer, jinja_env, current_date)
+
+        # /simple/{package}/index.html and /pypi/{package}/...
+        # Rebuild if the files are different for this package.
+        with timings.phase('packages'):
+            changed_packages = _changed_packages(packages, sorted_packages, previous_packages)
+            _build_packages(changed_packages, settings, writer, jinja_env, current_date, timings)
+            # Packages which were removed since the previous build. Their
+            # outputs are known from their previous files, so there's no need
+            # to look through the output tree for stale ones.
+            if previous_packages is not None:
+                for package_name in sorted(previous_packages.keys() - packages.keys()):
+                    _remove_package(package_name, previous_packages[package_name], settings, writer)
+
+        # /pypi/{package}/dependents.json
+        # Rebuild for packages whose dependents might have changed.
+        if settings.reverse_dependencies:
+            with timings.phase('dependents'):
+                _build_dependents(sorted_packages, previous_packages, changed_packages, writer)
+
+        # /bulk/{shard}.json and /latest.json
+        # Rebuild the shards with changed packages in them.
+        if settings.bulk_json:
+            with timings.phase('bulk_json'):
+                _build_bulk_json(sorted_packages, previous_packages, changed_packages, settings, writer)
+
+        # /changelog
+        # Only the newest pages are rebuilt; see _build_changelog.
+        with timings.phase('changelog'):
+            _build_changelog(sorted_packages, previous_packages, writer, jinja_env)
+
+        # /index.html
+        # Always rebuild (we would have short circuited already if nothing changed).
+        with timings.phase('index'):
+            _build_index(sorted_packages, writer, jinja_env)
+
+            # /search.json
+            # Rebuild if there are different package names or latest versions
+            # (or if it's missing, e.g. in a tree built before it existed).
+            if (
+                    names_changed or
+                    _latest_versions_changed(changed_packages) or
+                    not writer._exists('search.json')
+            ):
+                _build_search_index(sorted_packages, writer)
+
+        # /packages.json
+        # Always rebuild (we would have short circuited already if nothing changed).
+        with timings.phase('packages_json'):
+            _build_packages_json(sorted_packages, writer)
+
+        # /packages.snapshot
+        # The parsed state of packages.json, for the next partial rebuild.
+        with timings.phase('snapshot'):
+            _write_snapshot(sorted_packages, writer)
+
+    if settings.digest_file:
+        assert writer.digests is not None
+        with atomic_write(settings.digest_file) as f:
+            json.dump(writer.digests, f, sort_keys=True)
+    if settings.manifest:
+        assert writer.changes is not None
+        _write_manifest(settings.manifest, settings.manifest_format, writer.changes)
+    if settings.skip_unchanged:
+        print(
+            f'Wrote {writer.written} files, skipped {writer.skipped} unchanged files.',
+            file=sys.stderr,
+        )
+
+    timings.counts.update(
+        packages=len(packages),
+        files=sum(len(files) for files in packages.values()),
+        packages_rebuilt=len(changed_packages),
+        files_written=writer.written,
+        files_skipped=writer.skipped,
+        bytes_written=writer.bytes_written,
+    )
+
+
+def _lines_from_path(path: str) -> Iterator[str]:
+    # Stream the lines rather than reading the whole file in, so that parsing
+    # overlaps with reading and huge package lists don't need to fit in memory
+    # twice.
+    with contextlib.ExitStack() as ctx:
+        f = sys.stdin if path == '-' else ctx.enter_context(open(path))
+        for line in f:
+            # sys.stdin doesn't translate \r\n line endings.
+            yield line.rstrip('\r\n')
 
 
 def _create_packages(
@@ -439,6 +1938,111 @@ def package_list_json(path: str) -> dict[str, set[Package]]:
     return _create_packages(json.loads(line) for line in _lines_from_path(path))
 
 
+def _read_package_list(path: str | None, json_path: str | None) -> dict[str, set[Package]] | None:
+    if path is not None:
+        return package_list(path)
+    elif json_path is not None:
+        return package_list_json(json_path)
+    else:
+        return None
+
+
+class _PackageListWatcher:
+    """Reads a package list file, and re-reads it when it changes.
+
+    Each line is only parsed the first time it is seen; later reads reuse the
+    Package created for it (or skip it again, if it was invalid).
+    """
+
+    def __init__(self, path: str, *, is_json: bool) -> None:
+        self.path = path
+        self.is_json = is_json
+        self._stat: tuple[int, int, int] | None = None
+        self._packages_by_line: dict[str, Package | None] = {}
+
+    def _current_stat(self) -> tuple[int, int, int] | None:
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+    def changed(self) -> bool:
+        return self._current_stat() != self._stat
+
+    def read(self) -> dict[str, set[Package]]:
+        # Stat before reading so that a write during the read is picked up
+        # by the next call to changed().
+        self._stat = self._current_stat()
+        packages_by_line = {}
+        packages: dict[str, set[Package]] = collections.defaultdict(set)
+        for line in _lines_from_path(self.path):
+            try:
+                package = self._packages_by_line[line]
+            except KeyError:
+                package_info = json.loads(line) if self.is_json else {'filename': line}
+                try:
+                    package = Package.create(**package_info)
+                except ValueError as ex:
+                    print(f'{ex} (skipping package)', file=sys.stderr)
+                    package = None
+            packages_by_line[line] = package
+            if package is not None:
+                packages[package.name].add(package)
+        self._packages_by_line = packages_by_line
+        return packages
+
+
+def _watch(
+        watcher: _PackageListWatcher,
+        packages: dict[str, set[Package]],
+        sorted_packages: dict[str, list[Package]],
+        settings: Settings,
+        interval: float,
+        *,
+        add_metadata: Callable[[dict[str, set[Package]]], None] | None = None,
+) -> None:
+    """Rebuild whenever the package list changes, until interrupted.
+
+    The packages and their sorted files are kept between builds, so each
+    rebuild is a partial rebuild of just the packages which changed.
+    add_metadata (e.g. add_wheel_metadata) is applied to the packages after
+    each read.
+    """
+    print(f'Watching {watcher.path} for changes...', file=sys.stderr)
+    while True:
+        time.sleep(interval)
+        if not watcher.changed():
+            continue
+
+        start = time.perf_counter()
+        try:
+            new_packages = watcher.read()
+        except (OSError, ValueError) as ex:
+            # Most likely the file is being written to in place; try again on
+            # the next change.
+            print(f'Failed to read {watcher.path}: {ex!r}', file=sys.stderr)
+            continue
+        try:
+            if add_metadata is not None:
+                add_metadata(new_packages)
+            # As after the first read, the memos aren't needed until the next
+            # one (the watcher only parses lines it hasn't seen before), so
+            # don't let them grow with every rebuild.
+            _parsed_filenames.clear()
+            _interned_requires_dist.clear()
+            new_sorted_packages = _sort_packages(new_packages, sorted_packages)
+            build_repo(new_packages, packages, settings, previous_sorted_packages=new_sorted_packages)
+        except Exception as ex:
+            # e.g. a failed upload or a full disk. Keep the last packages which
+            # were built, so that the next build (on the next change) also
+            # redoes whatever this one didn't get to.
+            print(f'Failed to rebuild: {ex!r}', file=sys.stderr)
+            continue
+        packages, sorted_packages = new_packages, new_sorted_packages
+        print(f'Rebuilt in {time.perf_counter() - start:.2f}s.', file=sys.stderr)
+
+
 def main(argv: Sequence[str] | None = None) -> int:
     parser = argparse.ArgumentParser(
         description=__doc__,
@@ -449,32 +2053,49 @@ def main(argv: Sequence[str] | None = None) -> int:
     package_input_group.add_argument(
         '--package-list',
         help='path to a list of packages (one per line)',
-        type=package_list,
-        dest='packages',
     )
     package_input_group.add_argument(
         '--package-list-json',
         help='path to a list of packages (one JSON object per line)',
-        type=package_list_json,
-        dest='packages',
     )
 
     previous_package_input_group = parser.add_mutually_exclusive_group(required=False)
     previous_package_input_group.add_argument(
         '--previous-package-list',
         help='path to the previous list of packages (for partial rebuilds)',
-        type=package_list,
-        dest='previous_packages',
     )
     previous_package_input_group.add_argument(
         '--previous-package-list-json',
         help='path to the previous list of packages (for partial rebuilds)',
-        type=package_list_json,
-        dest='previous_packages',
+    )
+    previous_package_input_group.add_argument(
+        '--previous-snapshot',
+        help=(
+            'path to the packages.snapshot written by the previous build (for '
+            'partial rebuilds)\n'
+            'This is much faster to load than the previous list of packages.'
+        ),
     )
 
-    parser.add_argument(
-        '--output-dir', help='path to output to', required=True,
+    output_group = parser.add_mutually_exclusive_group(required=True)
+    output_group.add_argument(
+        '--output-dir', help='path to output to',
+    )
+    output_group.add_argument(
+        '--output-s3', metavar='s3://BUCKET[/PREFIX]',
+        help=(
+            'upload the outputs to an S3 bucket instead (credentials and region '
+            'are found as usual for boto3)\n'
+            'Only the outputs which are written get uploaded; requires the boto3 package.'
+        ),
+    )
+    output_group.add_argument(
+        '--output-tar',
+        help=(
+            'path to write the outputs to as a tar archive instead (use - for '
+            'stdout)\n'
+            'Partial rebuilds only include the outputs which were written.'
+        ),
     )
     parser.add_argument(
         '--packages-url',
@@ -509,18 +2130,314 @@ def main(argv: Sequence[str] | None = None) -> int:
             'a huge number of files for little benefit as almost no tools use it.'
         ),
     )
+    parser.add_argument(
+        '--packages-dir',
+        help=(
+            'path to a local copy of the packages (e.g. the directory served '
+            'at --packages-url)\n'
+            'The METADATA of each wheel found there is read to fill in its '
+            'dependencies, and\n'
+            'written next to it as <wheel>.metadata, so that pip can fetch it '
+            '(PEP 658)\n'
+            'instead of downloading the whole wheel.'
+        ),
+    )
+    parser.add_argument(
+        '--simple-json',
+        action='store_true',
+        help=(
+            'Also write the JSON simple API (PEP 691) as index.json next to '
+            'each /simple/ page.\n'
+            'See the README for how to serve it to clients which ask for it.'
+        ),
+    )
+    parser.add_argument(
+        '--reverse-dependencies',
+        action='store_true',
+        help=(
+            'Also write the packages which depend on each package (going by '
+            'the requires_dist of their\n'
+            'latest release) to /pypi/<package>/dependents.json.'
+        ),
+    )
+    parser.add_argument(
+        '--bulk-json',
+        action='store_true',
+        help=(
+            'Also write the /pypi/<package>/json of all packages in 256 shards '
+            '(/bulk/00.json to /bulk/ff.json),\n'
+            'and the latest version of each package to /latest.json, for '
+            'mirrors which fetch everything.'
+        ),
+    )
+    parser.add_argument(
+        '--jobs', '-j', type=int, default=1,
+        help=(
+            'Number of processes to use for rendering per-package pages, and of '
+            'threads for reading wheels from --packages-dir (default: 1).\n'
+            'Pass 0 to use one per CPU.'
+        ),
+    )
+    parser.add_argument(
+        '--skip-unchanged', action='store_true',
+        help=(
+            'Leave outputs whose contents have not changed untouched instead of '
+            'rewriting them.\n'
+            'This keeps their mtimes stable for tools like rsync and `aws s3 sync`.'
+        ),
+    )
+    parser.add_argument(
+        '--digest-file',
+        help=(
+            'path to a file to store digests of the outputs in, so that '
+            '--skip-unchanged can compare against them instead of reading the '
+            'existing files (implies --skip-unchanged)'
+        ),
+    )
+    parser.add_argument(
+        '--gzip', type=int, nargs='?', const=9, metavar='LEVEL', choices=range(1, 10),
+        help=(
+            'also write a gzipped copy of each HTML and JSON output next to it '
+            '(as <name>.gz), e.g. for nginx\'s gzip_static, with the given '
+            'compression level (1-9, default: 9)'
+        ),
+    )
+    parser.add_argument(
+        '--brotli', type=int, nargs='?', const=11, metavar='QUALITY', choices=range(12),
+        help=(
+            'also write a brotli-compressed copy of each HTML and JSON output '
+            'next to it (as <name>.br), with the given quality (0-11, default: '
+            '11); requires the brotli package'
+        ),
+    )
+    parser.add_argument(
+        '--output-tar-compression', choices=('none', 'gzip', 'zstd'),
+        help=(
+            'compression for --output-tar (default: from its extension, i.e. '
+            '.tar.gz/.tgz or .tar.zst/.tzst);\n'
+            'zstd requires the zstandard package'
+        ),
+    )
+    parser.add_argument(
+        '--s3-endpoint-url',
+        help='endpoint of an S3-compatible store to use with --output-s3 (e.g. MinIO)',
+    )
+    parser.add_argument(
+        '--s3-max-connections', type=int, default=16,
+        help=(
+            'maximum number of concurrent uploads for --output-s3, split between '
+            'the --jobs processes (default: 16)'
+        ),
+    )
+    parser.add_argument(
+        '--manifest',
+        help=(
+            'path to write a list of the outputs the build created, modified or '
+            'deleted to,\n'
+            'along with the SHA-256 of their new contents (e.g. for syncing them '
+            'or purging a CDN)'
+        ),
+    )
+    parser.add_argument(
+        '--manifest-format', choices=('jsonl', 'text'), default='jsonl',
+        help=(
+            'format of --manifest: one JSON object per line, or lines of '
+            '"<action> <sha256> <path>" (default: jsonl)'
+        ),
+    )
+    parser.add_argument(
+        '--timings',
+        help=(
+            'write per-phase wall and CPU timings, file and byte counts, and the '
+            'slowest packages to this path as JSON (use - for stderr)'
+        ),
+    )
+    parser.add_argument(
+        '--timings-slowest', type=int, default=10,
+        help='number of slowest packages to include with --timings (default: 10)',
+    )
+    parser.add_argument(
+        '--profile',
+        help=(
+            'write a cProfile dump of the build to this path (worker processes '
+            'started by --jobs are not profiled)'
+        ),
+    )
+
+    parser.add_argument(
+        '--cache-dir',
+        help=(
+            'directory to keep caches in between runs (of the names and '
+            'versions parsed from filenames, and of the compiled templates), to '
+            'speed up later builds'
+        ),
+    )
+    parser.add_argument(
+        '--watch', action='store_true',
+        help=(
+            'keep running after the build, and do a partial rebuild whenever '
+            'the package list changes (stop with Ctrl-C)'
+        ),
+    )
+    parser.add_argument(
+        '--watch-interval', type=float, default=1.0,
+        help='seconds between checks of the package list for --watch (default: 1)',
+    )
     args = parser.parse_args(argv)
+    if args.jobs < 0:
+        parser.error('--jobs must be 0 or more')
+    if args.watch and '-' in (args.package_list, args.package_list_json):
+        parser.error('--watch needs a package list file, not stdin')
+    if args.brotli is not None:
+        try:
+            import brotli  # noqa: F401
+        except ImportError:
+            parser.error('--brotli requires the brotli package (pip install dumb-pypi[brotli])')
+    if args.output_s3 is not None:
+        try:
+            _parse_s3_url(args.output_s3)
+        except ValueError as ex:
+            parser.error(str(ex))
+        try:
+            import boto3  # noqa: F401
+        except ImportError:
+            parser.error('--output-s3 requires the boto3 package (pip install dumb-pypi[s3])')
+    output_tar_compression = None
+    if args.output_tar is not None:
+        if args.watch:
+            parser.error('--watch needs --output-dir, not --output-tar')
+        if args.output_tar_compression is None:
+            output_tar_compression = _tar_compression(args.output_tar)
+        elif args.output_tar_compression != 'none':
+            output_tar_compression = args.output_tar_compression
+        if output_tar_compression == 'zstd':
+            try:
+                import zstandard  # noqa: F401
+            except ImportError:
+                parser.error('zstd compression requires the zstandard package (pip install dumb-pypi[zstd])')
+
+    timings = _Timings()
+    with timings.phase('parse'):
+        if args.cache_dir:
+            _load_parse_cache(args.cache_dir)
+        previous_sorted_packages = None
+        if args.previous_snapshot:
+            previous_sorted_packages = read_snapshot(args.previous_snapshot)
+        watcher = None
+        packages: dict[str, set[Package]] | None
+        if args.watch:
+            watcher = _PackageListWatcher(
+                args.package_list or args.package_list_json,
+                is_json=args.package_list_json is not None,
+            )
+            packages = watcher.read()
+        else:
+            packages = _read_package_list(args.package_list, args.package_list_json)
+        assert packages is not None
+        previous_packages: dict[str, set[Package]] | None
+        if previous_sorted_packages is not None:
+            previous_packages = {
+                name: set(files) for name, files in previous_sorted_packages.items()
+            }
+        else:
+            previous_packages = _read_package_list(args.previous_package_list, args.previous_package_list_json)
+        if args.cache_dir:
+            _save_parse_cache(
+                args.cache_dir,
+                {
+                    package.filename
+                    for packages_ in (packages, previous_packages or {})
+                    for files in packages_.values()
+                    for package in files
+                },
+            )
+        # The memo isn't needed once the package lists have been read, so
+        # don't hold on to it for the rest of the build.
+        _parsed_filenames.clear()
+
+    jobs = args.jobs or os.cpu_count() or 1
+    add_metadata = None
+    if args.packages_dir:
+        # Kept between the rebuilds of --watch.
+        known: dict[str, _WheelMetadata] = {}
+        add_metadata = functools.partial(
+            add_wheel_metadata,
+            packages_dir=args.packages_dir,
+            cache_dir=args.cache_dir,
+            jobs=jobs,
+            known=known,
+        )
+        with timings.phase('metadata'):
+            add_metadata(packages)
+            if previous_packages is not None:
+                # The previous package list doesn't have the metadata of its
+                # wheels unless it's a packages.json or snapshot, and without
+                # it every package with a wheel would look changed.
+                add_known_wheel_metadata(previous_packages, known)
+
+    if watcher is not None:
+        # Keep the sorted files around for the rebuilds.
+        with timings.phase('sort'):
+            previous_sorted_packages = _sort_packages(packages, previous_sorted_packages)
 
     settings = Settings(
-        output_dir=args.output_dir,
+        output_dir=args.output_dir or '',
         packages_url=args.packages_url,
         title=args.title,
         logo=args.logo,
         logo_width=args.logo_width,
         generate_timestamp=args.generate_timestamp,
         disable_per_release_json=args.no_per_release_json,
+        jobs=jobs,
+        skip_unchanged=args.skip_unchanged or args.digest_file is not None,
+        digest_file=args.digest_file,
+        cache_dir=args.cache_dir,
+        gzip_level=args.gzip,
+        brotli_quality=args.brotli,
+        simple_json=args.simple_json,
+        output_tar=args.output_tar,
+        output_tar_compression=output_tar_compression,
+        output_s3=args.output_s3,
+        s3_endpoint_url=args.s3_endpoint_url,
+        s3_max_connections=args.s3_max_connections,
+        manifest=args.manifest,
+        manifest_format=args.manifest_format,
+        reverse_dependencies=args.reverse_dependencies,
+        bulk_json=args.bulk_json,
     )
-    build_repo(args.packages, args.previous_packages, settings)
+    if args.profile:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.runcall(
+            build_repo, packages, previous_packages, settings,
+            previous_sorted_packages=previous_sorted_packages, timings=timings,
+        )
+        profiler.dump_stats(args.profile)
+    else:
+        build_repo(
+            packages, previous_packages, settings,
+            previous_sorted_packages=previous_sorted_packages, timings=timings,
+        )
+
+    if args.timings:
+        report = timings.report(args.timings_slowest)
+        if args.timings == '-':
+            print(json.dumps(report, indent=2), file=sys.stderr)
+        else:
+            with atomic_write(args.timings) as f:
+                json.dump(report, f, indent=2)
+
+    if watcher is not None:
+        with contextlib.suppress(KeyboardInterrupt):
+            assert previous_sorted_packages is not None
+            _watch(
+                watcher,
+                packages,
+                previous_sorted_packages,
+                settings,
+                args.watch_interval,
+                add_metadata=add_metadata,
+            )
     return 0
 
 
@@ -64,6 +64,36 @@ def tmpweb(running_server, tmpdir):
     return UrlAndPath(f'{running_server.url}/{name}', path)
 
 
+S3Bucket = collections.namedtuple('S3Bucket', ('endpoint_url', 'name', 'client'))
+
+
+@pytest.fixture(scope='session')
+def s3_server():
+    """Run a local stand-in for S3 (moto's server) and provide its URL."""
+    moto_server = pytest.importorskip('moto.server')
+    ip = '127.0.0.1'
+    port = ephemeral_port_reserve.reserve(ip=ip)
+    server = moto_server.ThreadedMotoServer(ip_address=ip, port=port, verbose=False)
+    server.start()
+    try:
+        yield f'http://{ip}:{port}'
+    finally:
+        server.stop()
+
+
+@pytest.fixture
+def s3_bucket(s3_server, monkeypatch):
+    """Provide an empty bucket on the local S3 stand-in."""
+    boto3 = pytest.importorskip('boto3')
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+    client = boto3.client('s3', endpoint_url=s3_server)
+    name = str(uuid.uuid4())
+    client.create_bucket(Bucket=name)
+    return S3Bucket(s3_server, name, client)
+
+
 def install_pip(version, path):
     # Old versions of pip don't work with python3.6.
     subprocess.check_call(('virtualenv', '-p', 'python2.7', path.strpath))
@@ -1,8 +1,21 @@
 from __future__ import annotations
 
+import collections
+import gzip
+import hashlib
+import io
 import json
+import os
+import pickle
+import pstats
 import re
+import shutil
+import subprocess
+import sys
+import tarfile
+import zipfile
 
+import jinja2
 import pytest
 
 from dumb_pypi import main
@@ -398,6 +411,9 @@ def test_build_repo_partial_rebuild(tmp_path):
     assert (tmp_path / 'pypi' / 'd' / '0.0.1' / 'json').is_file()
 
     assert (tmp_path / 'index.html').is_file()
+    assert json.loads((tmp_path / 'search.json').read_text()) == [
+        ['a', '0.0.2'], ['b', '0.0.3'], ['c', '0.0.2'], ['d', '0.0.1'],
+    ]
     assert (tmp_path / 'changelog').is_dir()
 
     expected = [
@@ -421,6 +437,276 @@ def test_build_repo_partial_rebuild(tmp_path):
     assert found == expected
 
 
+def test_build_repo_simple_json(tmp_path):
+    previous_packages = tmp_path / 'previous-packages'
+    _write_json_package_list(previous_packages, ({'filename': 'a-1.0.tar.gz'},))
+    main.main((
+        '--package-list-json', str(previous_packages),
+        '--output-dir', str(tmp_path),
+        '--packages-url', '../../pool/',
+        '--simple-json',
+    ))
+    assert json.loads((tmp_path / 'simple' / 'index.json').read_text()) == {
+        'meta': {'api-version': '1.0'},
+        'projects': [{'name': 'a'}],
+    }
+
+    packages = tmp_path / 'packages'
+    _write_json_package_list(
+        packages,
+        (
+            {'filename': 'a-1.0.tar.gz'},
+            {'filename': 'B-2.0.tar.gz', 'hash': 'sha256=abcd', 'requires_python': '>=3.8'},
+            {'filename': 'B-1.0-py3-none-any.whl', 'upload_timestamp': 1512539924},
+            {'filename': 'B-1.0.tar.gz'},
+        ),
+    )
+    (tmp_path / 'simple' / 'a' / 'index.json').write_text('untouched')
+    main.main((
+        '--previous-package-list-json', str(previous_packages),
+        '--package-list-json', str(packages),
+        '--output-dir', str(tmp_path),
+        '--packages-url', '../../pool/',
+        '--simple-json',
+    ))
+    assert (tmp_path / 'simple' / 'a' / 'index.json').read_text() == 'untouched'
+    assert json.loads((tmp_path / 'simple' / 'index.json').read_text())['projects'] == [
+        {'name': 'a'}, {'name': 'b'},
+    ]
+    assert json.loads((tmp_path / 'simple' / 'b' / 'index.json').read_text()) == {
+        'meta': {'api-version': '1.0'},
+        'name': 'b',
+        'files': [
+            {
+                'filename': 'B-1.0-py3-none-any.whl',
+                'url': '../../pool/B-1.0-py3-none-any.whl',
+                'hashes': {},
+                'upload-time': '2017-12-06T05:58:44.000000Z',
+            },
+            {
+                'filename': 'B-1.0.tar.gz',
+                'url': '../../pool/B-1.0.tar.gz',
+                'hashes': {},
+            },
+            {
+                'filename': 'B-2.0.tar.gz',
+                'url': '../../pool/B-2.0.tar.gz',
+                'hashes': {'sha256': 'abcd'},
+                'requires-python': '>=3.8',
+            },
+        ],
+        'versions': ['1.0', '2.0'],
+    }
+
+
+WHEEL_METADATA = b"""\
+Metadata-Version: 2.1
+Name: a
+Version: 1
+Requires-Python: >=3.8
+Requires-Dist: six
+Requires-Dist: cfgv (>=1) ; extra == "x"
+
+A description.
+"""
+
+
+def _write_wheel(path, metadata=WHEEL_METADATA):
+    with zipfile.ZipFile(path, 'w') as zf:
+        zf.writestr('a/__init__.py', '')
+        if metadata is not None:
+            zf.writestr(f'{path.name.split("-")[0]}-1.dist-info/METADATA', metadata)
+
+
+def test_build_repo_packages_dir(tmp_path, monkeypatch, capsys):
+    packages_dir = tmp_path / 'pool'
+    packages_dir.mkdir()
+    _write_wheel(packages_dir / 'a-1-py3-none-any.whl')
+    _write_wheel(packages_dir / 'b-1-py3-none-any.whl')
+    (packages_dir / 'c-1-py3-none-any.whl').write_bytes(b'not a zip')
+    _write_wheel(packages_dir / 'd-1-py3-none-any.whl', metadata=None)
+    (packages_dir / 'a-1.tar.gz').write_bytes(b'')
+    package_list = tmp_path / 'package-list'
+    _write_json_package_list(
+        package_list,
+        (
+            {'filename': 'a-1-py3-none-any.whl'},
+            {'filename': 'a-1.tar.gz'},
+            # Metadata from the package list wins.
+            {'filename': 'b-1-py3-none-any.whl', 'requires_dist': [], 'requires_python': '>=3.10'},
+            {'filename': 'c-1-py3-none-any.whl'},
+            {'filename': 'd-1-py3-none-any.whl'},
+            # Not available locally.
+            {'filename': 'e-1-py3-none-any.whl'},
+        ),
+    )
+    output_dir = tmp_path / 'output'
+    args = (
+        '--package-list-json', str(package_list),
+        '--output-dir', str(output_dir),
+        '--packages-url', '../../pool/',
+        '--packages-dir', str(packages_dir),
+        '--cache-dir', str(tmp_path / 'cache'),
+        '--simple-json',
+    )
+    main.main(args)
+    assert sorted(capsys.readouterr().err.splitlines()) == [
+        'Unable to read metadata from c-1-py3-none-any.whl: File is not a zip file',
+        'Unable to read metadata from d-1-py3-none-any.whl: expected one .dist-info/METADATA file, found 0',
+    ]
+    assert sorted(p.name for p in packages_dir.glob('*.metadata')) == [
+        'a-1-py3-none-any.whl.metadata', 'b-1-py3-none-any.whl.metadata',
+    ]
+    assert (packages_dir / 'a-1-py3-none-any.whl.metadata').read_bytes() == WHEEL_METADATA
+    metadata_hash = f'sha256={hashlib.sha256(WHEEL_METADATA).hexdigest()}'
+
+    page = (output_dir / 'simple' / 'a' / 'index.html').read_text()
+    assert f'data-dist-info-metadata="{metadata_hash}"' in page
+    assert f'data-core-metadata="{metadata_hash}"' in page
+    assert page.count('data-core-metadata') == 1
+    simple_json = json.loads((output_dir / 'simple' / 'a' / 'index.json').read_text())
+    assert simple_json['files'][0]['core-metadata'] == {'sha256': hashlib.sha256(WHEEL_METADATA).hexdigest()}
+
+    packages = {
+        line['filename']: line
+        for line in map(json.loads, (output_dir / 'packages.json').read_text().splitlines())
+    }
+    assert packages['a-1-py3-none-any.whl'] == {
+        'filename': 'a-1-py3-none-any.whl',
+        'metadata_hash': metadata_hash,
+        'requires_dist': ['six', 'cfgv (>=1) ; extra == "x"'],
+        'requires_python': '>=3.8',
+    }
+    assert packages['b-1-py3-none-any.whl'] == {
+        'filename': 'b-1-py3-none-any.whl',
+        'metadata_hash': metadata_hash,
+        'requires_dist': [],
+        'requires_python': '>=3.10',
+    }
+    assert packages['e-1-py3-none-any.whl'] == {'filename': 'e-1-py3-none-any.whl'}
+
+    # The metadata is cached by size and mtime, as long as the .metadata file
+    # is still there.
+    (packages_dir / 'c-1-py3-none-any.whl').unlink()
+    (packages_dir / 'd-1-py3-none-any.whl').unlink()
+    monkeypatch.setattr(main, '_read_wheel_metadata', lambda path: pytest.fail(path))
+    (packages_dir / 'b-1-py3-none-any.whl.metadata').unlink()
+    with pytest.raises(pytest.fail.Exception, match='b-1-py3-none-any.whl'):
+        main.main(args)
+    (packages_dir / 'b-1-py3-none-any.whl').unlink()
+    main.main(args)
+    assert f'data-core-metadata="{metadata_hash}"' in (output_dir / 'simple' / 'a' / 'index.html').read_text()
+
+
+def test_packages_dir_watch(tmp_path, monkeypatch):
+    packages_dir = tmp_path / 'pool'
+    packages_dir.mkdir()
+    _write_wheel(packages_dir / 'a-1-py3-none-any.whl')
+    _write_wheel(packages_dir / 'b-1-py3-none-any.whl')
+    package_list = tmp_path / 'package-list'
+    package_list.write_text('a-1-py3-none-any.whl\n')
+    output_dir = tmp_path / 'output'
+    a_metadata = packages_dir / 'a-1-py3-none-any.whl.metadata'
+
+    def updates():
+        os.utime(a_metadata, (0, 0))
+        package_list.write_text('a-1-py3-none-any.whl\nb-1-py3-none-any.whl\n')
+        yield
+        raise KeyboardInterrupt
+
+    update = updates()
+    monkeypatch.setattr(main.time, 'sleep', lambda interval: next(update))
+    read = []
+    read_wheel_metadata = main._read_wheel_metadata
+
+    def _read_wheel_metadata(path):
+        read.append(os.path.basename(path))
+        return read_wheel_metadata(path)
+
+    monkeypatch.setattr(main, '_read_wheel_metadata', _read_wheel_metadata)
+    main.main((
+        '--package-list', str(package_list),
+        '--output-dir', str(output_dir),
+        '--packages-url', '../../pool/',
+        '--packages-dir', str(packages_dir),
+        '--watch',
+    ))
+    assert 'data-core-metadata' in (output_dir / 'simple' / 'a' / 'index.html').read_text()
+    assert 'data-core-metadata' in (output_dir / 'simple' / 'b' / 'index.html').read_text()
+    # Only the new wheel is read by the rebuild, even without a cache.
+    assert read == ['a-1-py3-none-any.whl', 'b-1-py3-none-any.whl']
+    assert a_metadata.stat().st_mtime == 0
+
+
+def test_packages_dir_partial_rebuild(tmp_path):
+    packages_dir = tmp_path / 'pool'
+    packages_dir.mkdir()
+    _write_wheel(packages_dir / 'a-1-py3-none-any.whl')
+    _write_wheel(packages_dir / 'b-1-py3-none-any.whl')
+    previous_package_list = tmp_path / 'previous-package-list'
+    previous_package_list.write_text('a-1-py3-none-any.whl\na-1.tar.gz\nb-1-py3-none-any.whl\n')
+    package_list = tmp_path / 'package-list'
+    package_list.write_text('a-1-py3-none-any.whl\na-1.tar.gz\nb-1-py3-none-any.whl\nc-1.tar.gz\n')
+    timings = tmp_path / 'timings.json'
+    main.main((
+        '--package-list', str(package_list),
+        '--previous-package-list', str(previous_package_list),
+        '--output-dir', str(tmp_path / 'output'),
+        '--packages-url', '../../pool/',
+        '--packages-dir', str(packages_dir),
+        '--timings', str(timings),
+    ))
+    # The wheels in the raw previous list get their metadata too, so they
+    # aren't seen as changed.
+    assert json.loads(timings.read_text())['packages_rebuilt'] == 1
+
+
+def test_add_wheel_metadata_known(tmp_path, monkeypatch):
+    packages_dir = tmp_path / 'pool'
+    packages_dir.mkdir()
+    _write_wheel(packages_dir / 'a-1-py3-none-any.whl')
+    cache_dir = tmp_path / 'cache'
+    main.add_wheel_metadata({'a': {main.Package.create(filename='a-1-py3-none-any.whl')}}, str(packages_dir))
+    metadata = packages_dir / 'a-1-py3-none-any.whl.metadata'
+    os.utime(metadata, (0, 0))
+    # Without a cache the wheel is read again, but the identical metadata
+    # file isn't rewritten.
+    known: dict[str, main._WheelMetadata] = {}
+    main.add_wheel_metadata(
+        {'a': {main.Package.create(filename='a-1-py3-none-any.whl')}},
+        str(packages_dir), cache_dir=str(cache_dir), known=known,
+    )
+    assert set(known) == {'a-1-py3-none-any.whl'}
+    assert metadata.stat().st_mtime == 0
+
+    # Known wheels aren't looked at again, and the cache isn't touched.
+    monkeypatch.setattr(main, '_read_wheel_metadata', lambda path: pytest.fail(path))
+    monkeypatch.setattr(main, '_load_metadata_cache', lambda cache_dir: pytest.fail(cache_dir))
+    monkeypatch.setattr(main, '_save_metadata_cache', lambda cache_dir, cache: pytest.fail(cache_dir))
+    (packages_dir / 'a-1-py3-none-any.whl').unlink()
+    packages = {'a': {main.Package.create(filename='a-1-py3-none-any.whl')}}
+    main.add_wheel_metadata(packages, str(packages_dir), cache_dir=str(cache_dir), known=known)
+    (package,) = packages['a']
+    assert package.metadata_hash == f'sha256={hashlib.sha256(WHEEL_METADATA).hexdigest()}'
+
+    # Wheels no longer in the package list are forgotten.
+    main.add_wheel_metadata({}, str(packages_dir), cache_dir=str(cache_dir), known=known)
+    assert known == {}
+
+
+def test_metadata_cache_unreadable(tmp_path, capsys):
+    (tmp_path / main.METADATA_CACHE_FILENAME).write_bytes(b'garbage')
+    assert main._load_metadata_cache(str(tmp_path)) == {}
+    assert capsys.readouterr().err.startswith('Ignoring unreadable metadata cache: ')
+
+
+def test_metadata_cache_from_other_version(tmp_path):
+    with (tmp_path / main.METADATA_CACHE_FILENAME).open('wb') as f:
+        pickle.dump(main.METADATA_CACHE_VERSION - 1, f)
+        pickle.dump({'a-1-py3-none-any.whl': ()}, f)
+    assert main._load_metadata_cache(str(tmp_path)) == {}
+
+
 def test_build_repo_partial_rebuild_new_version_only(tmp_path):
     package_list = (
         {"filename": "a-0.0.1.tar.gz"},
@@ -442,18 +728,248 @@ def test_build_repo_partial_rebuild_new_version_only(tmp_path):
     ))
 
     assert not (tmp_path / 'simple' / 'index.html').is_file()
+    # b's latest version changed.
+    assert json.loads((tmp_path / 'search.json').read_text()) == [['a', '0.0.1'], ['b', '0.0.2']]
 
     assert not (tmp_path / 'simple' / 'a').is_dir()
     assert not (tmp_path / 'pypi' / 'a').is_dir()
 
     assert (tmp_path / 'simple' / 'b' / 'index.html').is_file()
     assert (tmp_path / 'pypi' / 'b' / 'json').is_file()
-    assert (tmp_path / 'pypi' / 'b' / '0.0.1' / 'json').is_file()
+    # Only the new version's JSON is generated.
+    assert not (tmp_path / 'pypi' / 'b' / '0.0.1').is_dir()
+    assert (tmp_path / 'pypi' / 'b' / '0.0.2' / 'json').is_file()
 
     assert (tmp_path / 'index.html').is_file()
     assert (tmp_path / 'changelog').is_dir()
 
 
+def test_build_repo_partial_rebuild_search_index(tmp_path):
+    previous_packages = tmp_path / 'previous-packages'
+    packages = tmp_path / 'packages'
+    _write_json_package_list(previous_packages, ({'filename': 'a-2.tar.gz'},))
+    # An older version doesn't change the latest version.
+    _write_json_package_list(packages, ({'filename': 'a-1.tar.gz'}, {'filename': 'a-2.tar.gz'}))
+    args = (
+        '--previous-package-list-json', str(previous_packages),
+        '--package-list-json', str(packages),
+        '--output-dir', str(tmp_path),
+        '--packages-url', '../../pool/',
+    )
+    main.main(args)
+    # e.g. the tree was built before search.json existed.
+    assert json.loads((tmp_path / 'search.json').read_text()) == [['a', '2']]
+
+    (tmp_path / 'search.json').write_text('untouched')
+    main.main(args)
+    assert (tmp_path / 'search.json').read_text() == 'untouched'
+
+
+def test_build_repo_partial_rebuild_per_release_json(tmp_path):
+    previous_packages = tmp_path / 'previous-packages'
+    _write_json_package_list(
+        previous_packages,
+        (
+            {'filename': 'a-1.tar.gz'},
+            {'filename': 'a-2.tar.gz'},
+            {'filename': 'a-3.tar.gz'},
+            # Files without a version don't get per-release JSON.
+            {'filename': 'a.zip'},
+        ),
+    )
+    main.main((
+        '--package-list-json', str(previous_packages),
+        '--output-dir', str(tmp_path),
+        '--packages-url', '../../pool/',
+    ))
+    pypi = tmp_path / 'pypi' / 'a'
+    for version in ('1', '2', '3'):
+        (pypi / version / 'json').write_text('untouched')
+
+    packages = tmp_path / 'packages'
+    _write_json_package_list(
+        packages,
+        (
+            # 1 is unchanged.
+            {'filename': 'a-1.tar.gz'},
+            # 2 has a new file.
+            {'filename': 'a-2.tar.gz'},
+            {'filename': 'a-2-py3-none-any.whl'},
+            # 3 and the unversioned file were removed, and 4 is new.
+            {'filename': 'a-4.tar.gz'},
+        ),
+    )
+    main.main((
+        '--previous-package-list-json', str(previous_packages),
+        '--package-list-json', str(packages),
+        '--output-dir', str(tmp_path),
+        '--packages-url', '../../pool/',
+    ))
+    assert (pypi / '1' / 'json').read_text() == 'untouched'
+    release = json.loads((pypi / '2' / 'json').read_text())
+    assert [f['filename'] for f in release['urls']] == ['a-2-py3-none-any.whl', 'a-2.tar.gz']
+    assert not (pypi / '3').exists()
+    assert (pypi / '4' / 'json').is_file()
+
+
+@pytest.mark.parametrize('extra_args', ((), ('--no-per-release-json',)))
+def test_build_repo_partial_rebuild_removed_package(tmp_path, extra_args):
+    previous_packages = tmp_path / 'previous-packages'
+    _write_json_package_list(
+        previous_packages,
+        (
+            {'filename': 'a-1.tar.gz'},
+            {'filename': 'b-1.tar.gz'},
+            {'filename': 'b-2.tar.gz'},
+            {'filename': 'b.zip'},
+        ),
+    )
+    output_dir = tmp_path / 'output'
+    args = (
+        '--output-dir', str(output_dir),
+        '--packages-url', '../../pool/',
+        '--simple-json',
+        *extra_args,
+    )
+    main.main(('--package-list-json', str(previous_packages), *args))
+    assert (output_dir / 'pypi' / 'b' / 'json').is_file()
+
+    packages = tmp_path / 'packages'
+    _write_json_package_list(packages, ({'filename': 'a-1.tar.gz'},))
+    main.main((
+        '--previous-package-list-json', str(previous_packages),
+        '--package-list-json', str(packages),
+        *args,
+    ))
+    assert not (output_dir / 'simple' / 'b').exists()
+    assert not (output_dir / 'pypi' / 'b').exists()
+    assert (output_dir / 'simple' / 'a' / 'index.json').is_file()
+    assert (output_dir / 'pypi' / 'a' / 'json').is_file()
+
+
+def _dependents(output_dir, package_name):
+    return json.loads((output_dir / 'pypi' / package_name / 'dependents.json').read_text())['dependents']
+
+
+def test_build_repo_reverse_dependencies(tmp_path):
+    previous_packages = tmp_path / 'previous-packages'
+    _write_json_package_list(
+        previous_packages,
+        (
+            {'filename': 'a-1.tar.gz', 'requires_dist': ['b>=1', 'C; extra == "x"', 'not valid!']},
+            {'filename': 'b-1.tar.gz', 'requires_dist': ['c']},
+            # Only the latest release counts.
+            {'filename': 'b-2.tar.gz', 'requires_dist': []},
+            {'filename': 'c-1.tar.gz'},
+            {'filename': 'e-1.tar.gz', 'requires_dist': ['c']},
+        ),
+    )
+    output_dir = tmp_path / 'output'
+    args = (
+        '--output-dir', str(output_dir),
+        '--packages-url', '../../pool/',
+        '--reverse-dependencies',
+    )
+    main.main(('--package-list-json', str(previous_packages), *args))
+    assert _dependents(output_dir, 'a') == []
+    assert _dependents(output_dir, 'b') == [{'name': 'a', 'version': '1', 'requires': ['b>=1']}]
+    assert _dependents(output_dir, 'c') == [
+        {'name': 'a', 'version': '1', 'requires': ['C; extra == "x"']},
+        {'name': 'e', 'version': '1', 'requires': ['c']},
+    ]
+    for package_name in ('b', 'e'):
+        (output_dir / 'pypi' / package_name / 'dependents.json').write_text('untouched')
+
+    packages = tmp_path / 'packages'
+    _write_json_package_list(
+        packages,
+        (
+            # a was removed, and b has a new release.
+            {'filename': 'b-1.tar.gz', 'requires_dist': ['c']},
+            {'filename': 'b-2.tar.gz', 'requires_dist': []},
+            {'filename': 'b-3.tar.gz', 'requires_dist': ['c']},
+            {'filename': 'c-1.tar.gz'},
+            # d is new.
+            {'filename': 'd-1.tar.gz', 'requires_dist': ['c>1']},
+            {'filename': 'e-1.tar.gz', 'requires_dist': ['c']},
+        ),
+    )
+    main.main((
+        '--previous-package-list-json', str(previous_packages),
+        '--package-list-json', str(packages),
+        *args,
+    ))
+    assert not (output_dir / 'pypi' / 'a').exists()
+    assert _dependents(output_dir, 'b') == []
+    assert _dependents(output_dir, 'c') == [
+        {'name': 'b', 'version': '3', 'requires': ['c']},
+        {'name': 'd', 'version': '1', 'requires': ['c>1']},
+        {'name': 'e', 'version': '1', 'requires': ['c']},
+    ]
+    assert _dependents(output_dir, 'd') == []
+    # Nothing that depends on e changed.
+    assert (output_dir / 'pypi' / 'e' / 'dependents.json').read_text() == 'untouched'
+
+
+def test_build_repo_bulk_json(tmp_path):
+    previous_packages = tmp_path / 'previous-packages'
+    _write_json_package_list(
+        previous_packages,
+        (
+            {'filename': 'a-1.tar.gz'},
+            {'filename': 'a-2.tar.gz'},
+            {'filename': 'b-1.tar.gz'},
+            {'filename': 'c-1.tar.gz'},
+            {'filename': 'Some.Package-1.tar.gz'},
+        ),
+    )
+    output_dir = tmp_path / 'output'
+    args = (
+        '--output-dir', str(output_dir),
+        '--packages-url', '../../pool/',
+        '--bulk-json',
+    )
+    main.main(('--package-list-json', str(previous_packages), *args))
+    assert len(list((output_dir / 'bulk').iterdir())) == 256
+    shard = output_dir / 'bulk' / f'{main._bulk_shard("a")}.json'
+    assert json.loads(shard.read_text())['a'] == json.loads((output_dir / 'pypi' / 'a' / 'json').read_text())
+    # Shards go by the SHA-256 of the canonical name.
+    some_package_shard = hashlib.sha256(b'some-package').hexdigest()[:2]
+    assert 'some-package' in json.loads((output_dir / 'bulk' / f'{some_package_shard}.json').read_text())
+    assert json.loads((output_dir / 'latest.json').read_text()) == {
+        'a': '2', 'b': '1', 'c': '1', 'some-package': '1',
+    }
+    for path in (output_dir / 'bulk').iterdir():
+        path.write_text('untouched')
+
+    packages = tmp_path / 'packages'
+    _write_json_package_list(
+        packages,
+        (
+            # a has a new version, b was removed, and c is unchanged.
+            {'filename': 'a-1.tar.gz'},
+            {'filename': 'a-2.tar.gz'},
+            {'filename': 'a-3.tar.gz'},
+            {'filename': 'c-1.tar.gz'},
+            {'filename': 'Some.Package-1.tar.gz'},
+        ),
+    )
+    main.main((
+        '--previous-package-list-json', str(previous_packages),
+        '--package-list-json', str(packages),
+        *args,
+    ))
+    changed = {
+        path.name: json.loads(path.read_text())
+        for path in (output_dir / 'bulk').iterdir()
+        if path.read_text() != 'untouched'
+    }
+    assert set(changed) == {f'{main._bulk_shard(name)}.json' for name in ('a', 'b')}
+    assert changed[f'{main._bulk_shard("a")}.json']['a']['info']['version'] == '3'
+    assert not any('b' in shard for shard in changed.values())
+    assert json.loads((output_dir / 'latest.json').read_text()) == {'a': '3', 'c': '1', 'some-package': '1'}
+
+
 def test_build_repo_partial_rebuild_no_changes_at_all(tmp_path):
     package_list = (
         {"filename": "a-0.0.1.tar.gz"},
@@ -524,6 +1040,309 @@ def test_build_repo_even_with_bad_package_names(tmpdir):
     assert tmpdir.join('simple', 'ocflib', 'index.html').check(file=True)
 
 
+def test_lines_from_path(tmp_path):
+    path = tmp_path / 'package-list'
+    path.write_bytes(b'a-1.tar.gz\r\n\nb-1.tar.gz\nc-1.tar.gz')
+    lines = main._lines_from_path(str(path))
+    assert next(lines) == 'a-1.tar.gz'
+    assert list(lines) == ['', 'b-1.tar.gz', 'c-1.tar.gz']
+
+
+def test_package_list_from_stdin(monkeypatch):
+    monkeypatch.setattr(sys, 'stdin', io.StringIO('a-1.tar.gz\nb-1.tar.gz\n'))
+    assert set(main.package_list('-')) == {'a', 'b'}
+
+
+def test_package_list_from_stdin_crlf(monkeypatch):
+    monkeypatch.setattr(sys, 'stdin', io.StringIO('a-1.tar.gz\r\nb-1.tar.gz\r\n', newline=''))
+    assert set(main.package_list('-')) == {'a', 'b'}
+
+
+def test_package_list_json_from_stdin(monkeypatch):
+    monkeypatch.setattr(sys, 'stdin', io.StringIO('{"filename": "a-1.tar.gz", "upload_timestamp": 1}\n'))
+    packages = main.package_list_json('-')
+    assert packages == {'a': {main.Package.create(filename='a-1.tar.gz', upload_timestamp=1)}}
+
+
+def test_parse_filename_shares_parsed_versions():
+    _, _, a = main._parse_filename('a-1.0.tar.gz')
+    _, _, b = main._parse_filename('b-1.0-py3-none-any.whl')
+    assert a is b
+
+
+def test_package_create_interns_shared_values():
+    a, b = (
+        main.Package.create(
+            filename=filename,
+            requires_dist=['six', 'cfgv'],
+            requires_python=''.join(('>=', '3.6')),
+            uploaded_by=''.join(('ck', 'uehl')),
+        )
+        for filename in ('a-1.0.tar.gz', 'a-1.0-py3-none-any.whl')
+    )
+    assert a.name is b.name
+    assert a.version is b.version
+    assert a.requires_dist is b.requires_dist
+    assert a.requires_python is b.requires_python
+    assert a.uploaded_by is b.uploaded_by
+
+
+@pytest.fixture
+def empty_parse_cache(monkeypatch):
+    monkeypatch.setattr(main, '_parsed_filenames', {})
+    monkeypatch.setattr(main, '_parsed_versions', {})
+
+
+def _cached_filenames(cache_dir):
+    with (cache_dir / main.PARSE_CACHE_FILENAME).open('rb') as f:
+        assert pickle.load(f) == main._parse_cache_header()
+        return set(pickle.load(f))
+
+
+def test_parse_cache(tmp_path, monkeypatch, empty_parse_cache):
+    cache_dir = tmp_path / 'cache'
+    previous_packages = tmp_path / 'previous-packages'
+    previous_packages.write_text('a-1.tar.gz\nb-1.tar.gz\n')
+    packages = tmp_path / 'packages'
+    packages.write_text('a-1.tar.gz\nc-1.tar.gz\n')
+    args = (
+        '--package-list', str(packages),
+        '--output-dir', str(tmp_path / 'output'),
+        '--packages-url', '../../pool/',
+        '--cache-dir', str(cache_dir),
+    )
+    main.main(args + ('--previous-package-list', str(previous_packages)))
+    assert _cached_filenames(cache_dir) == {'a-1.tar.gz', 'b-1.tar.gz', 'c-1.tar.gz'}
+
+    # A new run should not need to parse any of the filenames again.
+    monkeypatch.setattr(main, '_parsed_filenames', {})
+    monkeypatch.setattr(main, 'guess_name_version_from_filename', lambda filename: pytest.fail(filename))
+    main.main(args)
+    assert (tmp_path / 'output' / 'pypi' / 'c' / '1' / 'json').is_file()
+    # Filenames which no longer appear are dropped.
+    assert _cached_filenames(cache_dir) == {'a-1.tar.gz', 'c-1.tar.gz'}
+
+
+def test_parse_cache_from_other_version_is_ignored(tmp_path, empty_parse_cache):
+    with (tmp_path / main.PARSE_CACHE_FILENAME).open('wb') as f:
+        pickle.dump((main.PARSE_CACHE_VERSION - 1, 'old'), f)
+        pickle.dump({'a-1.tar.gz': ('nope', '1', None)}, f)
+    main._load_parse_cache(str(tmp_path))
+    assert main._parsed_filenames == {}
+
+
+def test_parse_cache_unreadable(tmp_path, capsys, empty_parse_cache):
+    (tmp_path / main.PARSE_CACHE_FILENAME).write_bytes(b'garbage')
+    main._load_parse_cache(str(tmp_path))
+    assert main._parsed_filenames == {}
+    assert capsys.readouterr().err.startswith('Ignoring unreadable parse cache: ')
+
+
+def test_jinja_bytecode_cache(tmp_path, monkeypatch):
+    settings = main.Settings(
+        output_dir=str(tmp_path / 'output'),
+        packages_url='../../pool/',
+        title='My Private PyPI',
+        logo='',
+        logo_width=0,
+        generate_timestamp=False,
+        disable_per_release_json=False,
+        cache_dir=str(tmp_path / 'cache'),
+    )
+    main._jinja_env.cache_clear()
+    rendered = main._jinja_env(settings).get_template('simple.html').render(package_names=['a'])
+    assert len(list((tmp_path / 'cache' / 'jinja').iterdir())) == 1
+
+    # A new environment loads the compiled templates from the cache.
+    main._jinja_env.cache_clear()
+    monkeypatch.setattr(jinja2.Environment, 'compile', lambda *args, **kwargs: pytest.fail('compiled'))
+    assert main._jinja_env(settings).get_template('simple.html').render(package_names=['a']) == rendered
+    main._jinja_env.cache_clear()
+
+
+def test_previous_snapshot(tmp_path, monkeypatch, empty_parse_cache):
+    output_dir = tmp_path / 'output'
+    previous_packages = tmp_path / 'previous-packages'
+    _write_json_package_list(
+        previous_packages,
+        ({'filename': 'a-1.tar.gz', 'upload_timestamp': 1}, {'filename': 'b-1.tar.gz'}),
+    )
+    main.main((
+        '--package-list-json', str(previous_packages),
+        '--output-dir', str(output_dir),
+        '--packages-url', '../../pool/',
+    ))
+    snapshot = output_dir / main.SNAPSHOT_FILENAME
+    assert main.read_snapshot(str(snapshot)) == {
+        name: sorted(files) for name, files in main.package_list_json(str(previous_packages)).items()
+    }
+
+    packages = tmp_path / 'packages'
+    _write_json_package_list(
+        packages,
+        ({'filename': 'a-1.tar.gz', 'upload_timestamp': 1}, {'filename': 'b-2.tar.gz'}),
+    )
+    # The filenames in the snapshot don't need to be parsed again.
+    monkeypatch.setattr(main, '_parsed_filenames', {})
+    monkeypatch.setattr(
+        main,
+        'guess_name_version_from_filename',
+        lambda filename, *, real=main.guess_name_version_from_filename: (
+            pytest.fail(filename) if filename == 'a-1.tar.gz' else real(filename)
+        ),
+    )
+    shutil.rmtree(output_dir / 'simple' / 'a')
+    main.main((
+        '--previous-snapshot', str(snapshot),
+        '--package-list-json', str(packages),
+        '--output-dir', str(output_dir),
+        '--packages-url', '../../pool/',
+    ))
+    # a is unchanged, so it wasn't rebuilt.
+    assert not (output_dir / 'simple' / 'a').exists()
+    assert (output_dir / 'pypi' / 'b' / '2' / 'json').is_file()
+    assert not (output_dir / 'pypi' / 'b' / '1').exists()
+    assert set(main.read_snapshot(str(snapshot)) or ()) == {'a', 'b'}
+    assert [p.filename for p in (main.read_snapshot(str(snapshot)) or {})['b']] == ['b-2.tar.gz']
+
+
+def test_previous_snapshot_missing_does_full_rebuild(tmp_path, capsys):
+    package_list = tmp_path / 'package-list'
+    package_list.write_text('a-1.tar.gz\n')
+    snapshot = tmp_path / 'output' / main.SNAPSHOT_FILENAME
+    main.main((
+        '--previous-snapshot', str(snapshot),
+        '--package-list', str(package_list),
+        '--output-dir', str(tmp_path / 'output'),
+        '--packages-url', '../../pool/',
+    ))
+    assert capsys.readouterr().err == f'Snapshot not found, doing a full rebuild: {snapshot}\n'
+    assert (tmp_path / 'output' / 'simple' / 'index.html').is_file()
+    assert snapshot.is_file()
+
+
+def test_read_snapshot_from_other_version(tmp_path, capsys):
+    snapshot = tmp_path / main.SNAPSHOT_FILENAME
+    with snapshot.open('wb') as f:
+        pickle.dump((main.SNAPSHOT_VERSION - 1, 'old', ()), f)
+        pickle.dump({}, f)
+    assert main.read_snapshot(str(snapshot)) is None
+    assert capsys.readouterr().err.startswith('Ignoring snapshot from another version of dumb-pypi: ')
+
+
+def test_read_snapshot_unreadable(tmp_path, capsys):
+    snapshot = tmp_path / main.SNAPSHOT_FILENAME
+    snapshot.write_bytes(b'garbage')
+    assert main.read_snapshot(str(snapshot)) is None
+    assert capsys.readouterr().err.startswith('Ignoring unreadable snapshot: ')
+
+
+def test_package_list_watcher(tmp_path, capsys):
+    package_list = tmp_path / 'package-list'
+    package_list.write_text('a-1.tar.gz\nnot-a-package\n')
+    watcher = main._PackageListWatcher(str(package_list), is_json=False)
+    assert watcher.changed()
+    packages = watcher.read()
+    assert not watcher.changed()
+    assert capsys.readouterr().err.endswith('(skipping package)\n')
+
+    package_list.write_text('a-1.tar.gz\nnot-a-package\nb-1.tar.gz\n')
+    assert watcher.changed()
+    new_packages = watcher.read()
+    assert set(new_packages) == {'a', 'b'}
+    # Lines seen before are reused rather than parsed (or warned about) again.
+    assert next(iter(new_packages['a'])) is next(iter(packages['a']))
+    assert capsys.readouterr().err == ''
+
+    package_list.unlink()
+    assert watcher.changed()
+
+
+def test_main_watch(tmp_path, monkeypatch, capsys):
+    package_list = tmp_path / 'package-list'
+    _write_json_package_list(package_list, ({'filename': 'a-1.tar.gz'},))
+    output_dir = tmp_path / 'output'
+
+    def updates():
+        # Nothing changed.
+        yield
+        _write_json_package_list(
+            package_list,
+            ({'filename': 'a-1.tar.gz'}, {'filename': 'b-1.tar.gz', 'requires_dist': ['six']}),
+        )
+        yield
+        assert (output_dir / 'pypi' / 'b' / '1' / 'json').is_file()
+        # The memos don't grow with every rebuild.
+        assert main._parsed_filenames == {}
+        assert main._interned_requires_dist == {}
+        package_list.write_text('{"filename": "half-writt')
+        yield
+        _write_json_package_list(package_list, ({'filename': 'b-1.tar.gz', 'requires_dist': ['six']},))
+        yield
+        raise KeyboardInterrupt
+
+    update = updates()
+    monkeypatch.setattr(main.time, 'sleep', lambda interval: next(update))
+    main.main((
+        '--package-list-json', str(package_list),
+        '--output-dir', str(output_dir),
+        '--packages-url', '../../pool/',
+        '--watch',
+    ))
+    assert (output_dir / 'packages.json').read_text() == '{"filename": "b-1.tar.gz", "requires_dist": ["six"]}\n'
+    err = capsys.readouterr().err.splitlines()
+    assert err[0] == f'Watching {package_list} for changes...'
+    assert err[1].startswith('Rebuilt in ')
+    assert err[2].startswith(f'Failed to read {package_list}: JSONDecodeError(')
+    assert err[3].startswith('Rebuilt in ')
+    assert len(err) == 4
+
+
+def test_main_watch_build_error(tmp_path, monkeypatch, capsys):
+    package_list = tmp_path / 'package-list'
+    package_list.write_text('a-1.tar.gz\n')
+    output_dir = tmp_path / 'output'
+    build_repo = main.build_repo
+
+    def failing_build_repo(*args, **kwargs):
+        raise OSError('disk full')
+
+    def updates():
+        monkeypatch.setattr(main, 'build_repo', failing_build_repo)
+        package_list.write_text('a-1.tar.gz\nb-1.tar.gz\n')
+        yield
+        assert not (output_dir / 'pypi' / 'b').exists()
+        monkeypatch.setattr(main, 'build_repo', build_repo)
+        package_list.write_text('a-1.tar.gz\nb-1.tar.gz\nc-1.tar.gz\n')
+        yield
+        raise KeyboardInterrupt
+
+    update = updates()
+    monkeypatch.setattr(main.time, 'sleep', lambda interval: next(update))
+    main.main((
+        '--package-list', str(package_list),
+        '--output-dir', str(output_dir),
+        '--packages-url', '../../pool/',
+        '--watch',
+    ))
+    # The failed build is redone along with the next one.
+    assert (output_dir / 'pypi' / 'b' / 'json').is_file()
+    assert (output_dir / 'pypi' / 'c' / 'json').is_file()
+    err = capsys.readouterr().err.splitlines()
+    assert err[1] == "Failed to rebuild: OSError('disk full')"
+    assert err[2].startswith('Rebuilt in ')
+
+
+def test_main_watch_stdin():
+    with pytest.raises(SystemExit):
+        main.main((
+            '--package-list', '-',
+            '--output-dir', 'output',
+            '--packages-url', '../../pool/',
+            '--watch',
+        ))
+
+
 def test_atomic_write(tmpdir):
     a = tmpdir.join('a')
     a.write('sup')
@@ -543,6 +1362,606 @@ def test_atomic_write_exception(tmpdir):
     assert a.read() == 'sup'
 
 
+@pytest.mark.parametrize(('mode', 'contents'), (('w', ('a', 'a', 'b')), ('wb', (b'a', b'a', b'b'))))
+def test_writer_skip_unchanged(tmp_path, mode, contents):
+    writer = main._Writer(str(tmp_path), skip_unchanged=True)
+    for content in contents:
+        with writer.open('dir/file', mode) as f:
+            f.write(content)
+    assert (tmp_path / 'dir' / 'file').read_text() == 'b'
+    assert (writer.written, writer.skipped) == (2, 1)
+
+
+def test_writer_stored_digests(tmp_path):
+    digests: dict[str, str] = {}
+    writer = main._Writer(str(tmp_path), skip_unchanged=True, digests=digests)
+    with writer.open('file') as f:
+        f.write('a')
+    assert digests == {'file': hashlib.sha256(b'a').hexdigest()}
+
+    # The stored digest is trusted over the file's contents...
+    (tmp_path / 'file').write_text('changed behind our back')
+    with writer.open('file') as f:
+        f.write('a')
+    assert (tmp_path / 'file').read_text() == 'changed behind our back'
+    # ...unless the file is gone.
+    (tmp_path / 'file').unlink()
+    with writer.open('file') as f:
+        f.write('a')
+    assert (tmp_path / 'file').read_text() == 'a'
+    assert (writer.written, writer.skipped) == (2, 1)
+
+    writer.remove('file')
+    assert digests == {}
+    assert writer.changed_digests == {'file': None}
+
+
+def test_writer_remove_cleans_up_empty_directories(tmp_path):
+    writer = main._Writer(str(tmp_path))
+    for name in ('a/b/c', 'a/d'):
+        with writer.open(name) as f:
+            f.write('')
+    writer.remove('a/b/c')
+    assert not (tmp_path / 'a' / 'b').exists()
+    assert (tmp_path / 'a' / 'd').is_file()
+    # Removing a missing file is fine.
+    writer.remove('a/b/c')
+
+
+def test_writer_precompressed(tmp_path):
+    brotli = pytest.importorskip('brotli')
+    writer = main._Writer(str(tmp_path), gzip_level=6, brotli_quality=5)
+    with writer.open('dir/file') as f:
+        f.write('a' * 100)
+    with writer.open('binary', 'wb') as f:
+        f.write(b'b' * 100)
+    assert gzip.decompress((tmp_path / 'dir' / 'file.gz').read_bytes()) == b'a' * 100
+    assert brotli.decompress((tmp_path / 'dir' / 'file.br').read_bytes()) == b'a' * 100
+    assert (writer.written, writer.bytes_written) == (2, 200)
+    # Only text outputs are compressed.
+    assert sorted(p.name for p in tmp_path.iterdir()) == ['binary', 'dir']
+
+    writer.remove('dir/file')
+    assert not (tmp_path / 'dir').exists()
+
+
+def test_writer_buffered_text_is_utf8(tmp_path):
+    writer = main._Writer(str(tmp_path), skip_unchanged=True)
+    with writer.open('file') as f:
+        f.write('caf\xe9\n')
+        f.write('\u2603')
+    assert (tmp_path / 'file').read_bytes() == 'caf\xe9\n\u2603'.encode()
+    assert writer.bytes_written == len('caf\xe9\n\u2603'.encode())
+
+
+def test_writer_precompressed_skip_unchanged(tmp_path):
+    writer = main._Writer(str(tmp_path), skip_unchanged=True, gzip_level=9)
+    with writer.open('file') as f:
+        f.write('a')
+    gz = tmp_path / 'file.gz'
+    gz.write_bytes(b'untouched')
+    with writer.open('file') as f:
+        f.write('a')
+    assert gz.read_bytes() == b'untouched'
+
+    # A missing compressed copy is written even if the output is unchanged.
+    gz.unlink()
+    with writer.open('file') as f:
+        f.write('a')
+    assert gzip.decompress(gz.read_bytes()) == b'a'
+    assert (writer.written, writer.skipped) == (1, 2)
+
+
+def test_main_gzip(tmp_path):
+    package_list = tmp_path / 'package-list'
+    package_list.write_text('a-1.tar.gz\n')
+    output_dir = tmp_path / 'output'
+    args = (
+        '--package-list', str(package_list),
+        '--output-dir', str(output_dir),
+        '--packages-url', '../../pool/',
+        '--no-generate-timestamp',
+        '--gzip',
+    )
+    main.main(args)
+    index = output_dir / 'simple' / 'a' / 'index.html'
+    assert gzip.decompress(index.with_name('index.html.gz').read_bytes()) == index.read_bytes()
+    assert (output_dir / 'packages.json.gz').is_file()
+    assert not (output_dir / (main.SNAPSHOT_FILENAME + '.gz')).exists()
+    assert not list(output_dir.rglob('*.br'))
+
+    # The compressed copies are repeatable.
+    before = _read_tree(output_dir)
+    main.main(args)
+    assert _read_tree(output_dir) == before
+
+
+def test_main_brotli_not_installed(tmp_path, monkeypatch, capsys):
+    monkeypatch.setitem(sys.modules, 'brotli', None)
+    with pytest.raises(SystemExit):
+        main.main((
+            '--package-list', str(tmp_path / 'package-list'),
+            '--output-dir', str(tmp_path / 'output'),
+            '--packages-url', '../../pool/',
+            '--brotli',
+        ))
+    assert '--brotli requires the brotli package' in capsys.readouterr().err
+
+
+def _read_tar(path, compression=None):
+    data = path.read_bytes()
+    if compression == 'zstd':
+        import zstandard
+        with zstandard.ZstdDecompressor().stream_reader(io.BytesIO(data)) as f:
+            data = b''.join(iter(lambda: f.read(65536), b''))
+    with tarfile.open(fileobj=io.BytesIO(data), mode='r:gz' if compression == 'gzip' else 'r:') as tar:
+        return {
+            member.name: tar.extractfile(member).read()  # type: ignore[union-attr]
+            for member in tar.getmembers()
+        }
+
+
+@pytest.mark.parametrize(
+    ('filename', 'extra_args', 'compression', 'jobs'),
+    (
+        ('output.tar', (), None, '1'),
+        ('output.tar', (), None, '2'),
+        ('output.tgz', (), 'gzip', '1'),
+        ('output.tar.gz', ('--output-tar-compression', 'none'), None, '1'),
+        ('output.archive', ('--output-tar-compression', 'gzip'), 'gzip', '1'),
+        ('output.tar.zst', (), 'zstd', '2'),
+    ),
+)
+def test_main_output_tar(tmp_path, filename, extra_args, compression, jobs):
+    if compression == 'zstd':
+        pytest.importorskip('zstandard')
+    package_list = tmp_path / 'package-list'
+    package_list.write_text('a-1.tar.gz\nb-1.tar.gz\nb-2.tar.gz\n')
+    args = (
+        '--package-list', str(package_list),
+        '--packages-url', '../../pool/',
+        '--no-generate-timestamp',
+        '--gzip',
+        '--jobs', jobs,
+    )
+    main.main((*args, '--output-dir', str(tmp_path / 'output')))
+    main.main((*args, '--output-tar', str(tmp_path / filename), *extra_args))
+    assert _read_tar(tmp_path / filename, compression) == _read_tree(tmp_path / 'output')
+
+
+def test_main_output_tar_partial_rebuild(tmp_path, capsys):
+    package_list = tmp_path / 'package-list'
+    package_list.write_text('a-1.tar.gz\nb-1.tar.gz\nb-2.tar.gz\n')
+    digest_file = tmp_path / 'digests.json'
+    output_tar = tmp_path / 'output.tar'
+    args = (
+        '--output-tar', str(output_tar),
+        '--packages-url', '../../pool/',
+        '--no-generate-timestamp',
+        '--digest-file', str(digest_file),
+    )
+    main.main(('--package-list', str(package_list), *args))
+    capsys.readouterr()
+
+    previous_package_list = tmp_path / 'previous-package-list'
+    package_list.rename(previous_package_list)
+    package_list.write_text('a-1.tar.gz\na-2.tar.gz\nb-1.tar.gz\n')
+    main.main((
+        '--package-list', str(package_list),
+        '--previous-package-list', str(previous_package_list),
+        *args,
+    ))
+    assert set(_read_tar(output_tar)) == {
+        'simple/a/index.html',
+        'simple/b/index.html',
+        'pypi/a/json',
+        'pypi/a/2/json',
+        'pypi/b/json',
+        'changelog/index.html',
+        'changelog/page1.html',
+        'search.json',
+        'packages.json',
+        main.SNAPSHOT_FILENAME,
+    }
+    assert capsys.readouterr().err == (
+        "1 outputs were removed, which the tar archive can't include: pypi/b/2/json\n"
+        'Wrote 10 files, skipped 1 unchanged files.\n'
+    )
+    assert 'pypi/b/2/json' not in json.loads(digest_file.read_text())
+
+
+def test_main_output_tar_no_changes(tmp_path):
+    package_list = tmp_path / 'package-list'
+    package_list.write_text('a-1.tar.gz\n')
+    output_tar = tmp_path / 'output.tar'
+    main.main((
+        '--package-list', str(package_list),
+        '--previous-package-list', str(package_list),
+        '--output-tar', str(output_tar),
+        '--packages-url', '../../pool/',
+    ))
+    assert _read_tar(output_tar) == {}
+
+
+def test_main_output_tar_stdout(tmp_path, capsysbinary):
+    package_list = tmp_path / 'package-list'
+    package_list.write_text('a-1.tar.gz\n')
+    main.main((
+        '--package-list', str(package_list),
+        '--output-tar', '-',
+        '--packages-url', '../../pool/',
+    ))
+    output_tar = tmp_path / 'output.tar'
+    output_tar.write_bytes(capsysbinary.readouterr().out)
+    assert 'simple/a/index.html' in _read_tar(output_tar)
+
+
+def test_main_output_tar_watch(tmp_path, capsys):
+    with pytest.raises(SystemExit):
+        main.main((
+            '--package-list', str(tmp_path / 'package-list'),
+            '--output-tar', str(tmp_path / 'output.tar'),
+            '--packages-url', '../../pool/',
+            '--watch',
+        ))
+    assert '--watch needs --output-dir' in capsys.readouterr().err
+
+
+def test_main_output_tar_zstandard_not_installed(tmp_path, monkeypatch, capsys):
+    monkeypatch.setitem(sys.modules, 'zstandard', None)
+    with pytest.raises(SystemExit):
+        main.main((
+            '--package-list', str(tmp_path / 'package-list'),
+            '--output-tar', str(tmp_path / 'output.tar.zst'),
+            '--packages-url', '../../pool/',
+        ))
+    assert 'zstd compression requires the zstandard package' in capsys.readouterr().err
+
+
+def test_tar_writer_merges_worker_outputs(tmp_path):
+    # Worker processes aren't measured by coverage, so exercise a worker's
+    # writer (which has no tar) directly.
+    worker_writer = main._TarWriter(None, gzip_level=9)
+    with worker_writer.open('simple/a/index.html') as f:
+        f.write('a')
+    worker_writer.remove('pypi/a/1/json')
+    output_tar = tmp_path / 'output.tar'
+    with main._open_tar(str(output_tar), None) as tar:
+        writer = main._TarWriter(tar)
+        writer.merge(*worker_writer.result())
+    assert (writer.written, writer.bytes_written) == (1, 1)
+    assert writer.deleted == ['pypi/a/1/json', 'pypi/a/1/json.gz']
+    contents = _read_tar(output_tar)
+    assert contents['simple/a/index.html'] == b'a'
+    assert gzip.decompress(contents['simple/a/index.html.gz']) == b'a'
+
+
+def _read_bucket(bucket, prefix=''):
+    paginator = bucket.client.get_paginator('list_objects_v2')
+    return {
+        obj['Key'][len(prefix):]: bucket.client.get_object(Bucket=bucket.name, Key=obj['Key'])['Body'].read()
+        for page in paginator.paginate(Bucket=bucket.name, Prefix=prefix)
+        for obj in page.get('Contents', ())
+    }
+
+
+@pytest.mark.parametrize('jobs', ('1', '2'))
+def test_main_output_s3(tmp_path, s3_bucket, jobs):
+    package_list = tmp_path / 'package-list'
+    package_list.write_text('a-1.tar.gz\nb-1.tar.gz\nb-2.tar.gz\n')
+    args = (
+        '--package-list', str(package_list),
+        '--packages-url', '../../pool/',
+        '--no-generate-timestamp',
+        '--simple-json',
+        '--jobs', jobs,
+    )
+    main.main((*args, '--output-dir', str(tmp_path / 'output')))
+    main.main((
+        *args,
+        '--output-s3', f's3://{s3_bucket.name}/pypi/',
+        '--s3-endpoint-url', s3_bucket.endpoint_url,
+        '--s3-max-connections', '2',
+    ))
+    assert _read_bucket(s3_bucket, 'pypi/') == _read_tree(tmp_path / 'output')
+
+    def content_type(key):
+        return s3_bucket.client.head_object(Bucket=s3_bucket.name, Key=key)['ContentType']
+    assert content_type('pypi/simple/a/index.html') == 'text/html; charset=utf-8'
+    assert content_type('pypi/simple/a/index.json') == main.SIMPLE_JSON_CONTENT_TYPE
+    assert content_type('pypi/pypi/a/json') == 'application/json'
+
+
+def test_main_output_s3_partial_rebuild(tmp_path, s3_bucket):
+    package_list = tmp_path / 'package-list'
+    package_list.write_text('a-1.tar.gz\nb-1.tar.gz\nb-2.tar.gz\n')
+    args = (
+        '--output-s3', f's3://{s3_bucket.name}',
+        '--s3-endpoint-url', s3_bucket.endpoint_url,
+        '--packages-url', '../../pool/',
+        '--digest-file', str(tmp_path / 'digests.json'),
+        '--gzip',
+    )
+    main.main(('--package-list', str(package_list), *args))
+    # Outputs which aren't rewritten aren't uploaded again.
+    s3_bucket.client.put_object(Bucket=s3_bucket.name, Key='simple/index.html', Body=b'untouched')
+
+    previous_package_list = tmp_path / 'previous-package-list'
+    package_list.rename(previous_package_list)
+    package_list.write_text('a-1.tar.gz\na-2.tar.gz\nb-1.tar.gz\n')
+    main.main((
+        '--package-list', str(package_list),
+        '--previous-package-list', str(previous_package_list),
+        *args,
+    ))
+    outputs = _read_bucket(s3_bucket)
+    assert outputs['simple/index.html'] == b'untouched'
+    assert 'pypi/a/2/json' in outputs
+    assert 'pypi/b/2/json' not in outputs
+    assert 'pypi/b/2/json.gz' not in outputs
+
+
+def test_main_output_s3_upload_error(tmp_path, s3_bucket):
+    import botocore.exceptions
+    package_list = tmp_path / 'package-list'
+    package_list.write_text('a-1.tar.gz\n')
+    with pytest.raises(botocore.exceptions.ClientError) as excinfo:
+        main.main((
+            '--package-list', str(package_list),
+            '--output-s3', 's3://no-such-bucket',
+            '--s3-endpoint-url', s3_bucket.endpoint_url,
+            '--packages-url', '../../pool/',
+        ))
+    assert 'NoSuchBucket' in str(excinfo.value)
+
+
+def _s3_settings(s3_bucket, url, **kwargs):
+    return main.Settings(
+        output_dir='',
+        packages_url='../../pool/',
+        title='My Private PyPI',
+        logo='',
+        logo_width=0,
+        generate_timestamp=False,
+        disable_per_release_json=False,
+        output_s3=url,
+        s3_endpoint_url=s3_bucket.endpoint_url,
+        **kwargs,
+    )
+
+
+@pytest.mark.parametrize(('jobs', 'expected'), ((1, 10), (4, 2), (32, 1)))
+def test_open_writer_s3_in_worker_splits_connections(s3_bucket, jobs, expected):
+    settings = _s3_settings(s3_bucket, f's3://{s3_bucket.name}', jobs=jobs, s3_max_connections=10)
+    with main._open_writer(settings, None) as writer:
+        assert isinstance(writer, main._S3Writer)
+        assert writer.max_connections == 10
+    with main._open_writer(settings, None, in_worker=True) as writer:
+        assert isinstance(writer, main._S3Writer)
+        assert writer.max_connections == expected
+
+
+def test_s3_writer_flush(s3_bucket):
+    settings = _s3_settings(s3_bucket, f's3://{s3_bucket.name}')
+    with main._open_writer(settings, None) as writer:
+        with writer.open('a') as f:
+            f.write('a')
+        writer.flush()
+        assert _read_bucket(s3_bucket) == {'a': b'a'}
+
+
+def test_s3_writer_upload_error_doesnt_hide_error(s3_bucket):
+    settings = _s3_settings(s3_bucket, 's3://no-such-bucket')
+    with pytest.raises(ValueError, match='^boom$'):
+        with main._open_writer(settings, None) as writer:
+            with writer.open('a') as f:
+                f.write('a')
+            writer.flush()
+            raise ValueError('boom')
+
+
+@pytest.mark.parametrize(
+    ('url', 'expected'),
+    (
+        ('s3://bucket', ('bucket', '')),
+        ('s3://bucket/', ('bucket', '')),
+        ('s3://bucket/some/prefix/', ('bucket', 'some/prefix/')),
+    ),
+)
+def test_parse_s3_url(url, expected):
+    assert main._parse_s3_url(url) == expected
+
+
+@pytest.mark.parametrize('url', ('bucket/prefix', 's3://', 'https://bucket/prefix'))
+def test_main_output_s3_bad_url(url, capsys):
+    with pytest.raises(SystemExit):
+        main.main((
+            '--package-list', 'package-list',
+            '--output-s3', url,
+            '--packages-url', '../../pool/',
+        ))
+    assert 'Not an s3://bucket/prefix URL' in capsys.readouterr().err
+
+
+def test_main_output_s3_boto3_not_installed(monkeypatch, capsys):
+    monkeypatch.setitem(sys.modules, 'boto3', None)
+    with pytest.raises(SystemExit):
+        main.main((
+            '--package-list', 'package-list',
+            '--output-s3', 's3://bucket',
+            '--packages-url', '../../pool/',
+        ))
+    assert '--output-s3 requires the boto3 package' in capsys.readouterr().err
+
+
+@pytest.mark.parametrize(
+    ('name', 'expected'),
+    (
+        ('changelog/page1.html', 'text/html; charset=utf-8'),
+        ('simple/index.json', 'application/vnd.pypi.simple.v1+json'),
+        ('pypi/a/1/json', 'application/json'),
+        ('packages.json', 'application/json'),
+        ('packages.json.gz', 'application/gzip'),
+        ('packages.snapshot', 'application/octet-stream'),
+    ),
+)
+def test_content_type(name, expected):
+    assert main._content_type(name) == expected
+
+
+@pytest.mark.parametrize('jobs', ('1', '2'))
+def test_build_repo_skip_unchanged(tmp_path, capsys, jobs):
+    package_list = tmp_path / 'package-list'
+    package_list.write_text('a-1.tar.gz\nb-1.tar.gz\n')
+    output_dir = tmp_path / 'output'
+    digest_file = tmp_path / 'digests.json'
+    args = (
+        '--package-list', str(package_list),
+        '--output-dir', str(output_dir),
+        '--packages-url', '../../pool/',
+        '--no-generate-timestamp',
+        '--digest-file', str(digest_file),
+        '--jobs', jobs,
+    )
+    main.main(args)
+    digests = json.loads(digest_file.read_text())
+    assert digests['simple/a/index.html'] == hashlib.sha256(
+        (output_dir / 'simple' / 'a' / 'index.html').read_bytes(),
+    ).hexdigest()
+    capsys.readouterr()
+
+    for path in output_dir.rglob('*'):
+        os.utime(path, (0, 0))
+    main.main(args)
+    assert all(path.stat().st_mtime == 0 for path in output_dir.rglob('*') if path.is_file())
+    assert capsys.readouterr().err == 'Wrote 0 files, skipped 13 unchanged files.\n'
+    assert json.loads(digest_file.read_text()) == digests
+
+
+def _read_manifest(path):
+    return {entry['path']: (entry['action'], entry['sha256']) for entry in map(json.loads, path.open())}
+
+
+def _sha256(path):
+    return hashlib.sha256(path.read_bytes()).hexdigest()
+
+
+@pytest.mark.parametrize('jobs', ('1', '2'))
+@pytest.mark.parametrize('extra_args', ((), ('--skip-unchanged',)))
+def test_main_manifest(tmp_path, jobs, extra_args):
+    package_list = tmp_path / 'package-list'
+    package_list.write_text('a-1.tar.gz\nb-1.tar.gz\nb-2.tar.gz\n')
+    output_dir = tmp_path / 'output'
+    manifest = tmp_path / 'manifest.jsonl'
+    args = (
+        '--output-dir', str(output_dir),
+        '--packages-url', '../../pool/',
+        '--no-generate-timestamp',
+        '--manifest', str(manifest),
+        '--jobs', jobs,
+        *extra_args,
+    )
+    main.main(('--package-list', str(package_list), *args))
+    assert _read_manifest(manifest) == {
+        str(path.relative_to(output_dir)): ('created', _sha256(path))
+        for path in output_dir.rglob('*') if path.is_file()
+    }
+
+    previous_package_list = tmp_path / 'previous-package-list'
+    package_list.rename(previous_package_list)
+    package_list.write_text('a-1.tar.gz\na-2.tar.gz\nb-1.tar.gz\n')
+    main.main((
+        '--package-list', str(package_list),
+        '--previous-package-list', str(previous_package_list),
+        *args,
+    ))
+    changes = _read_manifest(manifest)
+    assert changes['pypi/a/2/json'] == ('created', _sha256(output_dir / 'pypi' / 'a' / '2' / 'json'))
+    assert changes['simple/a/index.html'] == ('modified', _sha256(output_dir / 'simple' / 'a' / 'index.html'))
+    assert changes['pypi/b/2/json'] == ('deleted', None)
+    # The package names didn't change, so this wasn't rebuilt.
+    assert 'simple/index.html' not in changes
+    if extra_args:
+        # Rebuilt, but the same as before.
+        assert 'pypi/b/1/json' not in changes
+
+
+def test_main_manifest_text_compressed(tmp_path):
+    package_list = tmp_path / 'package-list'
+    package_list.write_text('a-1.tar.gz\n')
+    output_dir = tmp_path / 'output'
+    manifest = tmp_path / 'manifest.txt'
+    args = (
+        '--output-dir', str(output_dir),
+        '--packages-url', '../../pool/',
+        '--manifest', str(manifest),
+        '--manifest-format', 'text',
+        '--no-generate-timestamp',
+        '--gzip',
+        '--skip-unchanged',
+    )
+    main.main(('--package-list', str(package_list), *args))
+    gz = output_dir / 'simple' / 'a' / 'index.html.gz'
+    assert f'created {_sha256(gz)} simple/a/index.html.gz\n' in manifest.read_text()
+
+    # Only the missing compressed copy is written again.
+    gz.unlink()
+    main.main(('--package-list', str(package_list), '--previous-package-list', '/dev/null', *args))
+    lines = manifest.read_text().splitlines()
+    assert f'created {_sha256(gz)} simple/a/index.html.gz' in lines
+    assert not any(line.endswith(' simple/a/index.html') for line in lines)
+
+    # Nothing changed, so the manifest is empty.
+    main.main(('--package-list', str(package_list), '--previous-package-list', str(package_list), *args))
+    assert manifest.read_text() == ''
+
+
+@pytest.mark.parametrize('jobs', ('1', '2'))
+def test_build_repo_timings(tmp_path, jobs):
+    package_list = tmp_path / 'package-list'
+    package_list.write_text('a-1.tar.gz\nb-1.tar.gz\nb-2.tar.gz\n')
+    timings = tmp_path / 'timings.json'
+    main.main((
+        '--package-list', str(package_list),
+        '--output-dir', str(tmp_path / 'output'),
+        '--packages-url', '../../pool/',
+        '--timings', str(timings),
+        '--timings-slowest', '1',
+        '--jobs', jobs,
+    ))
+    report = json.loads(timings.read_text())
+    assert set(report['phases']) == {
+        'parse', 'jinja_env', 'sort', 'simple_index', 'packages', 'simple_pages', 'json_api', 'changelog',
+        'index', 'packages_json', 'snapshot',
+    }
+    assert all(set(phase) == {'wall', 'cpu'} for phase in report['phases'].values())
+    assert report['packages'] == report['packages_rebuilt'] == 2
+    assert report['files'] == 3
+    assert report['files_written'] == 14
+    assert report['files_skipped'] == 0
+    assert report['bytes_written'] == sum(
+        path.stat().st_size for path in (tmp_path / 'output').rglob('*') if path.is_file()
+    )
+    assert len(report['slowest_packages']) == 1
+    assert report['slowest_packages'][0]['name'] in {'a', 'b'}
+
+
+def test_build_repo_timings_to_stderr_and_profile(tmp_path, capsys):
+    package_list = tmp_path / 'package-list'
+    package_list.write_text('a-1.tar.gz\n')
+    profile = tmp_path / 'profile'
+    main.main((
+        '--package-list', str(package_list),
+        '--output-dir', str(tmp_path / 'output'),
+        '--packages-url', '../../pool/',
+        '--timings', '-',
+        '--profile', str(profile),
+    ))
+    assert json.loads(capsys.readouterr().err)['packages'] == 1
+    stats = pstats.Stats(str(profile))
+    assert any(func == 'build_repo' for _, _, func in stats.stats)  # type: ignore[attr-defined]
+
+
 def test_sorting():
     test_packages = [
         main.Package.create(filename=name)
@@ -586,3 +2005,295 @@ def test_sorting():
         'zpkg-1-cp39-cp39-manylinux_2_28_aarch64.whl',
         'zpkg-1-cp310-cp310-manylinux_2_28_aarch64.whl',
     ]
+
+
+def test_sort_packages_merges_into_previous_sorted():
+    def packages(*filenames):
+        ret: dict[str, set[main.Package]] = collections.defaultdict(set)
+        for filename in filenames:
+            package = main.Package.create(filename=filename)
+            ret[package.name].add(package)
+        return dict(ret)
+
+    previous = main._sort_packages(packages(
+        'a-1.0.tar.gz', 'a-1.0-py3-none-any.whl', 'a-2.0.tar.gz', 'b-1.0.tar.gz',
+    ))
+    current = packages(
+        'a-1.0-py3-none-any.whl', 'a-1.5.tar.gz', 'a-2.0.tar.gz', 'a-10.0.tar.gz',
+        'b-1.0.tar.gz', 'c-1.0.tar.gz',
+    )
+    sorted_packages = main._sort_packages(current, previous)
+    assert sorted_packages == {name: sorted(files) for name, files in current.items()}
+    # Unchanged packages reuse the previous list.
+    assert sorted_packages['b'] is previous['b']
+
+
+def test_build_changelog_order_matches_changelog_key(tmp_path):
+    files = [
+        main.Package.create(filename=filename, upload_timestamp=timestamp)
+        for filename, timestamp in (
+            ('b-1.0.tar.gz', 5),
+            ('a-1.0.tar.gz', 5),
+            ('a-1.0-py3-none-any.whl', 5),
+            ('a-2.0.tar.gz', None),
+            ('c-1.0.tar.gz', 7),
+            ('b-2.0.tar.gz', None),
+        )
+    ]
+    packages: dict[str, set[main.Package]] = collections.defaultdict(set)
+    for package in files:
+        packages[package.name].add(package)
+    settings = main.Settings(
+        output_dir=str(tmp_path),
+        packages_url='../../pool/',
+        title='My Private PyPI',
+        logo='',
+        logo_width=0,
+        generate_timestamp=False,
+        disable_per_release_json=False,
+    )
+    main._build_changelog(
+        main._sort_packages(packages), None, main._Writer(str(tmp_path)), main._jinja_env(settings),
+    )
+    assert _changelog_links(tmp_path / 'changelog' / 'page1.html') == [
+        package.filename for package in sorted(files, key=main._changelog_key)
+    ]
+
+
+def _read_tree(path):
+    return {
+        str(p.relative_to(path)): p.read_bytes()
+        for p in sorted(path.rglob('*'))
+        if p.is_file()
+    }
+
+
+def test_build_repo_jobs_matches_serial(tmp_path):
+    package_list = tmp_path / 'package-list'
+    _write_json_package_list(
+        package_list,
+        [
+            {'filename': f'pkg{i}-{v}.tar.gz', 'upload_timestamp': i * 10 + v}
+            for i in range(20)
+            for v in range(3)
+        ],
+    )
+    trees = []
+    for jobs in ('1', '3'):
+        output_dir = tmp_path / f'output-{jobs}'
+        main.main((
+            '--package-list-json', str(package_list),
+            '--output-dir', str(output_dir),
+            '--packages-url', '../../pool/',
+            '--no-generate-timestamp',
+            '--jobs', jobs,
+        ))
+        trees.append(_read_tree(output_dir))
+    serial, parallel = trees
+    assert 'pypi/pkg19/2/json' in serial
+    assert serial == parallel
+
+
+def test_main_negative_jobs(capsys):
+    with pytest.raises(SystemExit):
+        main.main((
+            '--package-list', 'package-list',
+            '--output-dir', 'output',
+            '--packages-url', '../../pool/',
+            '--jobs', '-1',
+        ))
+    assert '--jobs must be 0 or more' in capsys.readouterr().err
+
+
+def test_build_packages_chunk_in_process(tmp_path, monkeypatch):
+    # Worker processes aren't measured by coverage, so exercise the worker
+    # entry points directly.
+    monkeypatch.setattr(main, '_worker_state', None)
+    settings = main.Settings(
+        output_dir=str(tmp_path),
+        packages_url='../../pool/',
+        title='My Private PyPI',
+        logo='',
+        logo_width=0,
+        generate_timestamp=False,
+        disable_per_release_json=False,
+    )
+    main._init_worker(settings, '2018-06-09 23:26:45', None)
+    result, package_times, phases, cpu = main._build_packages_chunk(
+        [('a', [main.Package.create(filename='a-1.0.tar.gz')], None)],
+    )
+    written, skipped, bytes_written, digests, changes, outputs = result
+    assert (written, skipped, digests, changes, outputs) == (3, 0, {}, [], [])
+    assert bytes_written > 0
+    assert [name for _, name in package_times] == ['a']
+    assert set(phases) == {'simple_pages', 'json_api'}
+    assert (tmp_path / 'simple' / 'a' / 'index.html').is_file()
+    assert (tmp_path / 'pypi' / 'a' / '1.0' / 'json').is_file()
+
+
+def test_build_packages_chunk_in_process_output_tar(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, '_worker_state', None)
+    settings = main.Settings(
+        output_dir='',
+        packages_url='../../pool/',
+        title='My Private PyPI',
+        logo='',
+        logo_width=0,
+        generate_timestamp=False,
+        disable_per_release_json=False,
+        output_tar=str(tmp_path / 'output.tar'),
+    )
+    main._init_worker(settings, '2018-06-09 23:26:45', None)
+    result, _, _, _ = main._build_packages_chunk(
+        [('a', [main.Package.create(filename='a-1.0.tar.gz')], None)],
+    )
+    # The outputs are sent back for the parent to add to the tar.
+    *_, outputs = result
+    assert [name for name, _ in outputs] == ['simple/a/index.html', 'pypi/a/json', 'pypi/a/1.0/json']
+    assert not (tmp_path / 'output.tar').exists()
+
+
+def _changelog_links(path):
+    return re.findall('<a href="../../pool/([^"]+)"', path.read_text())
+
+
+def test_build_repo_changelog_pages_anchored_to_oldest(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, 'CHANGELOG_ENTRIES_PER_PAGE', 2)
+    package_list = tmp_path / 'package-list'
+    _write_json_package_list(
+        package_list,
+        [{'filename': f'a-{i}.tar.gz', 'upload_timestamp': i} for i in range(1, 6)],
+    )
+    main.main((
+        '--package-list-json', str(package_list),
+        '--output-dir', str(tmp_path),
+        '--packages-url', '../../pool/',
+    ))
+    changelog = tmp_path / 'changelog'
+    assert _changelog_links(changelog / 'page1.html') == ['a-2.tar.gz', 'a-1.tar.gz']
+    assert _changelog_links(changelog / 'page2.html') == ['a-4.tar.gz', 'a-3.tar.gz']
+    assert _changelog_links(changelog / 'page3.html') == ['a-5.tar.gz']
+    assert (changelog / 'index.html').read_text() == (changelog / 'page3.html').read_text()
+
+
+def test_build_repo_changelog_partial_rebuild_only_touches_newest_pages(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, 'CHANGELOG_ENTRIES_PER_PAGE', 2)
+    previous = [{'filename': f'a-{i}.tar.gz', 'upload_timestamp': i} for i in range(1, 5)]
+    previous_packages = tmp_path / 'previous-packages'
+    _write_json_package_list(previous_packages, previous)
+    main.main((
+        '--package-list-json', str(previous_packages),
+        '--output-dir', str(tmp_path),
+        '--packages-url', '../../pool/',
+    ))
+    changelog = tmp_path / 'changelog'
+    (changelog / 'page1.html').write_text('untouched')
+
+    packages = tmp_path / 'packages'
+    _write_json_package_list(packages, previous + [{'filename': 'a-5.tar.gz', 'upload_timestamp': 5}])
+    main.main((
+        '--previous-package-list-json', str(previous_packages),
+        '--package-list-json', str(packages),
+        '--output-dir', str(tmp_path),
+        '--packages-url', '../../pool/',
+    ))
+    assert (changelog / 'page1.html').read_text() == 'untouched'
+    # page2 was the newest page and now links to page3.
+    assert 'href="page3.html"' in (changelog / 'page2.html').read_text()
+    assert _changelog_links(changelog / 'page3.html') == ['a-5.tar.gz']
+    assert _changelog_links(changelog / 'index.html') == ['a-5.tar.gz']
+
+    # Removing the newest file drops the page that only held it.
+    main.main((
+        '--previous-package-list-json', str(packages),
+        '--package-list-json', str(previous_packages),
+        '--output-dir', str(tmp_path),
+        '--packages-url', '../../pool/',
+    ))
+    assert (changelog / 'page1.html').read_text() == 'untouched'
+    assert not (changelog / 'page3.html').exists()
+    assert 'href="page3.html"' not in (changelog / 'page2.html').read_text()
+    assert _changelog_links(changelog / 'index.html') == ['a-4.tar.gz', 'a-3.tar.gz']
+
+
+def test_build_repo_changelog_partial_rebuild_removing_every_package(tmp_path):
+    previous_package_list = tmp_path / 'previous-package-list'
+    previous_package_list.write_text('a-1.tar.gz\n')
+    package_list = tmp_path / 'package-list'
+    package_list.write_text('')
+    args = ('--output-dir', str(tmp_path / 'output'), '--packages-url', '../../pool/', '--gzip')
+    main.main(('--package-list', str(previous_package_list), *args))
+    assert (tmp_path / 'output' / 'changelog' / 'index.html.gz').is_file()
+    main.main((
+        '--package-list', str(package_list),
+        '--previous-package-list', str(previous_package_list),
+        *args,
+    ))
+    assert not (tmp_path / 'output' / 'changelog').exists()
+
+
+def test_build_repo_changelog_partial_rebuild_of_newest_first_pages(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, 'CHANGELOG_ENTRIES_PER_PAGE', 2)
+    previous = [{'filename': f'a-{i}.tar.gz', 'upload_timestamp': i} for i in range(1, 5)]
+    previous_packages = tmp_path / 'previous-packages'
+    _write_json_package_list(previous_packages, previous)
+    main.main((
+        '--package-list-json', str(previous_packages),
+        '--output-dir', str(tmp_path),
+        '--packages-url', '../../pool/',
+    ))
+    # Changelogs built by older versions had page1.html as the newest page,
+    # and no index.html.
+    changelog = tmp_path / 'changelog'
+    (changelog / 'page1.html').write_text('newest first')
+    (changelog / 'index.html').unlink()
+
+    packages = tmp_path / 'packages'
+    _write_json_package_list(packages, previous + [{'filename': 'a-5.tar.gz', 'upload_timestamp': 5}])
+    main.main((
+        '--previous-package-list-json', str(previous_packages),
+        '--package-list-json', str(packages),
+        '--output-dir', str(tmp_path),
+        '--packages-url', '../../pool/',
+    ))
+    assert _changelog_links(changelog / 'page1.html') == ['a-2.tar.gz', 'a-1.tar.gz']
+    assert _changelog_links(changelog / 'index.html') == ['a-5.tar.gz']
+
+
+def _imported_modules(stderr):
+    """Modules imported from dumb_pypi onwards, according to -X importtime.
+
+    Modules imported earlier (e.g. by site) are ignored, since those depend
+    on the environment.
+    """
+    # The lines look like: "import time: self | cumulative | name"
+    names = [
+        line.split('|')[-1].strip()
+        for line in stderr.splitlines()
+        if line.startswith('import time:')
+    ]
+    return set(names[names.index('dumb_pypi'):])
+
+
+def test_no_op_build_does_not_import_heavy_modules(tmp_path):
+    package_list = tmp_path / 'package-list'
+    package_list.write_text('a-1.tar.gz\n')
+    proc = subprocess.run(
+        (
+            sys.executable, '-X', 'importtime', '-c',
+            'import sys; from dumb_pypi.main import main; raise SystemExit(main())',
+            '--package-list', str(package_list),
+            '--previous-package-list', str(package_list),
+            '--output-dir', str(tmp_path / 'output'),
+            '--packages-url', '../../pool/',
+        ),
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    imported = _imported_modules(proc.stderr)
+    assert 'dumb_pypi.main' in imported
+    assert not imported & {
+        'concurrent.futures', 'cProfile', 'inspect', 'jinja2', 'packaging.tags', 'tempfile',
+    }
+    assert not (tmp_path / 'output').exists()